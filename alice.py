@@ -23,6 +23,16 @@ Sets of packed instructions are divided into blocks, the size of which is
 contained in the header. When we encounter the end of a block, we must pad
 with zeros until the next byte offset.
 
+A patched image can be re-encoded against an existing ALICE partition (-p).
+Only the blocks that differ are packed, with the dictionary and range
+registers of that partition, and spliced into its compressed stream.
+
+The range registers are fixed unless -r is given, which searches all of them
+for the smallest packed blocks plus dictionary.
+
+--stats times each stage and counts the symbols packed with each prefix, as
+unalice.py does for decoding.
+
 Requirements:
     python3
 
@@ -30,8 +40,6 @@ Copyright 2018 Donn Morrison donn.morrison@gmail.com
 
 TODO:
     - determine correct sorting of dictionary histogram
-    - dynamically generate range registers
-    - implement ALICE_1 encoding?
     - testing
 
 This program is free software: you can redistribute it and/or modify
@@ -49,214 +57,835 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import sys
+import json
+import heapq
 import struct
+import getopt
+import logging
+import multiprocessing
+from array import array
 from collections import Counter
 
-def translate_bl_blx():
-    global buff
-    ptr = 0 # ptr can be equiv to PC
-    bl_count = 0
-    blx_count = 0
-    while ptr < len(buff)/2-1:
-        if (ptr+1) % 32 == 0:
-            ptr += 1
-            continue
+import unalice
 
-        instr = buff[ptr*2] | (buff[ptr*2+1] << 8)
-        instr2 = buff[ptr*2+2] | (buff[ptr*2+3] << 8)
+log = logging.getLogger("alice")
 
-        if (instr & 0xf800) == 0xf000:
-            if (instr2 & 0xf800) == 0xf800: # bit 12 = 1, BL instruction
-                upbits = 0xf800
-                bl_count += 1
-            elif (instr2 & 0xf800) == 0xe800: # bit 12 = 0, BLX instruction
-                upbits = 0xe800
-                blx_count += 1
+def translate_bl_blx(buff):
+    # The pairs are found as unalice.py finds them to translate back
+    bl_count = 0
+    blx_count = 0
+    for ptr in unalice.bl_blx_pairs(buff):
+        instr, instr2 = struct.unpack_from("<HH", buff, ptr*2)
+        if (instr2 & 0xf800) == 0xf800: # bit 12 = 1, BL instruction
+            upbits = 0xf800
+            bl_count += 1
+        else: # bit 12 = 0, BLX instruction
+            upbits = 0xe800
+            blx_count += 1
+
+        if instr & 0x400: # if J2 bit is set
+            # shift imm11 left 11 bits, add lower bits from imm10 + sign
+            # multiply by two, subtract 0x7ffffffe?
+            v10 = 2 * (ptr + ((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff)) - 0x7ffffffe
+        else:
+            # shift imm11 left 11 bits, add lower bits from imm10 + sign
+            # multiply by two, add 2
+            v10 = 2 * (ptr + ((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff)) + 0x00000002
+
+        # reassemble branch target
+        instr = (v10 >> 0x0c) & 0x7ff | 0xf000 # high bits
+        instr2 = (v10 >> 1) & 0x7ff | upbits   # low bits
+        struct.pack_into("<HH", buff, ptr*2, instr, instr2)
+
+    log.info("translated %d bl and %d blx instructions", bl_count*2, blx_count*2)
+
+# Range registers as stored in the header, index bits per range. The 8th
+# range holds the rest of the instructions, unencoded (16 bits).
+range_bits = [4, 6, 7, 8, 9, 11, 12]
+
+# Smallest first range register -r tries. The first dictionary entry packs
+# as the all-zero code, which a decoder can mistake for the zero padding of
+# a short last block if it is much shorter than a byte. ALICE.exe images
+# all use 4.
+min_first_bits = 4
+
+def range_tables(bits):
+    # Cumulative dictionary sizes per range, encoded lengths (prefix + index)
+    # and prefixes per range, e.g. for range_bits:
+    #  range_regs = [0x0, 0x10, 0x50, 0xd0, 0x1d0, 0x3d0, 0xbd0, 0x1bd0]
+    #  codes = [0x07, 0x09, 0x0A, 0x0B, 0x0C, 0x0E, 0x0F, 0x13]
+    #  starts = [0x0, 0x40, 0x100, 0x300, 0x800, 0x2800, 0x6000, 0x70000]
+    bits = list(bits) + [16]
+    range_regs = [0]
+    for b in bits[0:-1]:
+        range_regs.append(range_regs[-1] + (1 << b))
+    codes = [b + 3 for b in bits]
+    starts = [r << b for r, b in enumerate(bits)]
+    return range_regs, codes, starts
+
+def le_instrs(buff, typecode='H'):
+    # Little endian words of buff as an array, a trailing odd byte is dropped
+    instrs = array(typecode)
+    instrs.frombytes(bytes(buff[0:len(buff) - len(buff) % instrs.itemsize]))
+    if sys.byteorder == 'big':
+        instrs.byteswap()
+    return instrs
+
+def histogram(instrs):
+    # instrs is an array('H') of the translated instructions. Returns
+    # (instruction, frequency) most frequent first.
+    # Need to make sure it is sorted in the same way ALICE.exe sorts, that being
+    # that first by frequency, then for instructions in the same frequency bin,
+    # possibly by instruction value, first location in ALICE.bin, or something
+    # else? Most likely ALICE.exe gets the order from the way the BST is
+    # traversed.
+
+    # Construct fake ALICE.bin with a desired histogram and try to match
+    # the output.
+    hist=Counter(instrs)
+    # Same frequency: by the instruction's bytes in ALICE.bin, low byte first
+    return sorted(hist.items(), key=lambda x: (-x[1], ((x[0] & 0xff) << 8) | (x[0] >> 8)))
+
+def make_dictionary(instrs, bits=range_bits, shist=None):
+    # Generate histogram, unless given
+    if shist is None:
+        shist = histogram(instrs)
+    range_regs, codes, starts = range_tables(bits)
+
+    # Generate magic vector, funked instructions dictionary (before_encode.bin),
+    # both flat tables indexed by instruction
+    magic = bytearray(0x10000)
+    fshist = array('I', bytes(4*0x10000))
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    for r in range(len(range_regs)):
+        if r < len(range_regs)-1:
+            entries = shist[range_regs[r]:range_regs[r+1]]
+        else:
+            entries = shist[range_regs[r]:] # the rest is stored unencoded
+        for instrnr, (instr_idx, freq) in enumerate(entries):
+            if r < len(range_regs)-1:
+                finstr = instrnr | starts[r]
             else:
-                ptr += 1
-                continue
-
-            if instr & 0x400: # if J2 bit is set
-                # shift imm11 left 11 bits, add lower bits from imm10 + sign
-                # multiply by two, subtract 0x7ffffffe?
-                v10 = 2 * (ptr + ((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff)) - 0x7ffffffe
+                finstr = instr_idx | starts[r]
+            if debug:
+                log.debug("0x%02x 0x%04x 0x%08x %d %d", codes[r], instr_idx, finstr, freq, range_regs[r] + instrnr)
+            # Magic
+            magic[ instr_idx ] = codes[r]
+            # Instr
+            fshist[ instr_idx ] = finstr
+
+    return magic, fshist
+
+def dictionary(magic, fshist):
+    # The dictionary as stored after the mapping table, the instruction for
+    # every index of the encoded ranges, from the magic and fshist tables
+    entries = {}
+    for instr_idx in range(0x10000):
+        length = magic[ instr_idx ]
+        if length == 0 or length == 0x13:
+            continue # not used, or unencoded
+        r = fshist[ instr_idx ] >> (length - 3)
+        entries[(r, fshist[ instr_idx ] & ((1 << (length - 3)) - 1))] = instr_idx
+    # Ranges follow each other, sizes from the highest index seen per range
+    # (a range is full unless the instructions ran out in it)
+    out = array('H')
+    for r in sorted(set(r for r, idx in entries)):
+        size = max(idx for rr, idx in entries if rr == r) + 1
+        out += array('H', [entries.get((r, idx), 0) for idx in range(size)])
+    return out
+
+def symbol_counts(shist, magic, fshist):
+    # Instructions packed with each 3-bit prefix, from the histogram. The
+    # prefix is the top 3 bits of each code.
+    symbols = [0]*8
+    for instr, freq in shist:
+        if magic[instr]:
+            symbols[fshist[instr] >> (magic[instr] - 3)] += freq
+    return symbols
+
+def cumulative(shist):
+    # cumfreqs[i] is the number of instructions among the i most frequent
+    cumfreqs = [0]
+    for instr, freq in shist:
+        cumfreqs.append(cumfreqs[-1] + freq)
+    return cumfreqs
+
+def predict_size(bits, shist, nblocks):
+    # Bytes of packed blocks plus dictionary for the given range registers.
+    # Each block is padded to a byte, 3.5 bits on average.
+    cumfreqs = cumulative(shist)
+    n = len(shist)
+    total = 0
+    i = 0
+    for b in bits:
+        j = min(i + (1 << b), n)
+        total += (b + 3)*(cumfreqs[j] - cumfreqs[i]) + 16*(j - i)
+        i = j
+    total += 19*(cumfreqs[n] - cumfreqs[i])
+    return int((total + 3.5*nblocks) / 8) + 1
+
+def optimize_range_bits(shist, nblocks, top=5):
+    # Try every set of range registers, smallest first (any optimum can be
+    # ordered so, the most frequent instructions get the shortest codes),
+    # the first from min_first_bits, up to 15 bits (16 is no better than unencoded). An instruction costs
+    # its code in every place it is used and 16 bits in the dictionary,
+    # block padding is the same for all. Returns the top candidates as
+    # (predicted bytes, bits), best first.
+    cumfreqs = cumulative(shist)
+    n = len(shist)
+    candidates = []
+
+    def search(bits, i, cost):
+        if len(bits) == 7 or i == n:
+            bits = bits + [bits[-1] if bits else min_first_bits]*(7 - len(bits)) # unused
+            candidates.append((cost + 19*(cumfreqs[n] - cumfreqs[i]), bits))
+            return
+        for b in range(bits[-1] if bits else min_first_bits, 16):
+            j = min(i + (1 << b), n)
+            search(bits + [b], j, cost + (b + 3)*(cumfreqs[j] - cumfreqs[i]) + 16*(j - i))
+            if j == n:
+                break # larger ranges change nothing
+
+    search([], 0, 0)
+    best = heapq.nsmallest(top, candidates)
+    return [(int((cost + 3.5*nblocks) / 8) + 1, bits) for cost, bits in best]
+
+def rank_by_packing(values, candidates, shist, blockinstrs=0x20):
+    # The predicted sizes take the same padding for every candidate. Returns
+    # (bytes, bits) smallest first with the exact size of packed blocks,
+    # tail byte and dictionary instead, from the sum of the code lengths in
+    # every block. Nothing is packed: each instruction is mapped once to its
+    # segment of the histogram between range boundaries of any candidate
+    # (fewer than 256), then a candidate's code lengths are one translate().
+    n = len(shist)
+    bounds = sorted(set([min(r, n) for predicted, bits in candidates for r in range_tables(bits)[0]] + [n]))
+    segment = bytearray(0x10000)
+    for s in range(len(bounds) - 1):
+        for instr, freq in shist[bounds[s]:bounds[s+1]]:
+            segment[instr] = s
+    segments = bytes(map(segment.__getitem__, values))
+    last = len(values) % blockinstrs or blockinstrs
+
+    ranked = []
+    for predicted, bits in candidates:
+        range_regs, codes, starts = range_tables(bits)
+        lengths = bytearray(256)
+        for s in range(len(bounds) - 1):
+            r = sum([1 for low in range_regs[1:] if low <= bounds[s]])
+            lengths[s] = codes[r]
+        codelens = segments.translate(lengths)
+        blocksums = [sum(codelens[i:i+blockinstrs]) for i in range(0, len(codelens), blockinstrs)]
+        size = sum([(blocksum + 7) >> 3 for blocksum in blocksums])
+        if last == blockinstrs or blocksums[-1] % 8 == 0:
+            size += 1 # tail byte, see tail_byte()
+        size += 2*min(n, range_regs[-1]) # dictionary
+        ranked.append((size, bits))
+    return sorted(ranked)
+
+def make_header(bits, base, compressed_len, mapping_len, blockinstrs=0x20, version=2):
+    # ALICE header (40 bytes). Addresses are where the parts end up, with
+    # the compressed blocks at base. ALICE_1 has no blocksize field (zero),
+    # its blocks are always 64 bytes.
+    mapping_addr = base + compressed_len
+    dict_addr = mapping_addr + mapping_len
+    blocksize = 2*blockinstrs
+    if version == 1:
+        if blocksize != 64:
+            raise ValueError("ALICE_1 blocks are 64 bytes, not %d"%(blocksize))
+        blocksize = 0
+    header = b'ALICE_%d\x00'%(version) + struct.pack("<LLL", base, mapping_addr, dict_addr)
+    header += struct.pack("<7H", *bits)
+    header += struct.pack("<HHH", 0x0109, blocksize, 0xffff) # 0x0109 unknown, as found in ALICE_2 images
+    return header
+
+def write_container(f, instrs, magic, fshist, bits, base, jobs=1, blockinstrs=0x20, version=2, stats=None):
+    # Write a complete ALICE component to the seekable file f: header,
+    # packed blocks, mapping table and dictionary. Blocks are written as
+    # they are packed, the header goes in last when the offsets are known.
+    # Returns the length of each part. stats (unalice.Stats) times packing
+    # and writing separately.
+    start = f.tell()
+    make_header(bits, base, 0, 0, blockinstrs, version) # fail early
+    with unalice.stage(stats, 'write'):
+        f.write(bytes(40))
+
+    length = 0
+    blocklens = array('H')
+    with unalice.stage(stats, 'bitpack'):
+        chunks = iter_packed(instrs, magic, code_table(magic, fshist), jobs, blockinstrs)
+    while True:
+        with unalice.stage(stats, 'bitpack'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        chunkbuff, chunklens = chunk
+        with unalice.stage(stats, 'write'):
+            f.write(chunkbuff)
+        length += len(chunkbuff)
+        blocklens += chunklens
+    tail = tail_byte(instrs, magic, blockinstrs)
+    length += len(tail)
+
+    with unalice.stage(stats, 'mapping table'):
+        table = mapping_table(blocklens, base, blockinstrs, last_padding(instrs, magic, blockinstrs))
+    with unalice.stage(stats, 'dictionary'):
+        entries = dictionary(magic, fshist)
+    if sys.byteorder == 'big':
+        table.byteswap()
+        entries.byteswap()
+    with unalice.stage(stats, 'write'):
+        f.write(tail)
+        f.write(table.tobytes())
+        f.write(entries.tobytes())
+        end = f.tell()
+        f.seek(start)
+        f.write(make_header(bits, base, length, 4*len(table), blockinstrs, version))
+        f.seek(end)
+    return {'header': 40, 'compressed': length, 'blocks': len(blocklens),
+        'mapping': 4*len(table), 'dictionary': 2*len(entries)}
+
+def code_table(magic, fshist):
+    # Flat code table, values trimmed to their encoded length
+    return [finstr & ((1 << length) - 1) for finstr, length in zip(fshist, magic)]
+
+def pack_blocks(instrs, magic, fcodes, blockinstrs=0x20):
+    # Pack the range encoded instructions MSB first. Bits collect in an
+    # accumulator and whole 64-bit words are flushed into a buffer allocated
+    # up front. Every block of blockinstrs instructions, including a short
+    # last one, is padded with zeros to the next byte. Returns the packed
+    # blocks and the length in bytes of each block.
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    n = len(instrs)
+    buff = bytearray((n*max(magic) + 7*(n//blockinstrs + 1)) // 8 + 16)
+    blocklens = array('H')
+    ptr = 0 # bytes flushed
+    acc = 0
+    accbits = 0
+    for block in range(0, n, blockinstrs):
+        blockstart = ptr*8 + accbits
+        for instr_idx in instrs[block:block+blockinstrs]:
+            bitnum = magic[ instr_idx ]
+            acc = (acc << bitnum) | fcodes[ instr_idx ]
+            accbits += bitnum
+            if debug:
+                log.debug("instr_idx %d 0x%04x packed 0x%08x length %d at bit %d", instr_idx, instr_idx, fcodes[ instr_idx ], bitnum, ptr*8 + accbits - bitnum)
+
+        # End of block, pad to the next byte
+        pad = -accbits & 7
+        acc <<= pad
+        accbits += pad
+        blocklens.append((ptr*8 + accbits - blockstart) >> 3)
+        if debug and (block // blockinstrs) % 2 == 1:
+            log.debug("hit instruction blocksize 0x%02x at ptr 0x%08x", 2*blockinstrs, ptr + (accbits >> 3))
+
+        while accbits >= 64:
+            accbits -= 64
+            struct.pack_into(">Q", buff, ptr, acc >> accbits)
+            acc &= (1 << accbits) - 1
+            ptr += 8
+
+    # Flush what is left, always whole bytes
+    tail = accbits >> 3
+    buff[ptr:ptr+tail] = acc.to_bytes(tail, 'big')
+    del buff[ptr+tail:]
+    return buff, blocklens
+
+def last_padding(instrs, magic, blockinstrs=0x20):
+    # Zero bits padding the last block of instrs to a byte
+    last = len(instrs) % blockinstrs or blockinstrs
+    return -sum(magic[ instr_idx ] for instr_idx in instrs[-last:]) & 7
+
+def tail_byte(instrs, magic, blockinstrs=0x20):
+    # ALICE.exe output always ends with the byte being filled, i.e. an extra
+    # zero byte unless a short last block ends in the middle of a byte
+    if len(instrs) % blockinstrs == 0 or last_padding(instrs, magic, blockinstrs) == 0:
+        return b'\x00'
+    return b''
+
+def bitpack(instrs, magic, fshist, blockinstrs=0x20):
+    buff, blocklens = pack_blocks(instrs, magic, code_table(magic, fshist), blockinstrs)
+    buff += tail_byte(instrs, magic, blockinstrs)
+    return buff
+
+_pack_state = None
+
+def init_pack(magic, fcodes, blockinstrs):
+    global _pack_state
+    _pack_state = (magic, fcodes, blockinstrs)
+
+def pack_chunk(instrs):
+    magic, fcodes, blockinstrs = _pack_state
+    return pack_blocks(instrs, magic, fcodes, blockinstrs)
+
+def iter_packed(instrs, magic, fcodes, jobs=1, blockinstrs=0x20, pairs=2048):
+    # Pack runs of block pairs in order and yield each run's packed blocks
+    # and block lengths. With the dictionary fixed every block packs on its
+    # own, so with jobs > 1 the runs are packed in a process pool.
+    pairinstrs = 2*blockinstrs
+    if jobs > 1:
+        npairs = -(-len(instrs) // pairinstrs)
+        pairs = min(pairs, max(1, -(-npairs // (jobs*4))))
+    size = pairs*pairinstrs
+    chunks = (array('H', instrs[i:i+size]) for i in range(0, len(instrs), size))
+    if jobs <= 1:
+        for chunk in chunks:
+            yield pack_blocks(chunk, magic, fcodes, blockinstrs)
+        return
+    with multiprocessing.Pool(jobs, init_pack, (magic, fcodes, blockinstrs)) as pool:
+        for result in pool.imap(pack_chunk, chunks):
+            yield result
+
+def parallel_pack(instrs, magic, fshist, jobs, blockinstrs=0x20):
+    buff = bytearray()
+    blocklens = array('H')
+    for chunkbuff, chunklens in iter_packed(instrs, magic, code_table(magic, fshist), jobs, blockinstrs):
+        buff += chunkbuff
+        blocklens += chunklens
+    buff += tail_byte(instrs, magic, blockinstrs)
+    return buff, blocklens
+
+def mapping_table(blocklens, base, blockinstrs=0x20, padding=None):
+    # One entry for every other block: 24-bit address of the block, top 6
+    # bits the length of the block in bytes less the shortest possible
+    # length (3 bits per instruction) less one, as read by unalice.py. The
+    # last entry is the end of the compressed data, its top bits padding
+    # (last_padding()) plus one so unalice.py knows exactly where the data
+    # stops. ALICE.exe leaves them zero.
+    extra = ((3*blockinstrs) >> 3) + 1
+    table = array('I')
+    addr = 0
+    for k in range(0, len(blocklens), 2):
+        length = min(max(blocklens[k] - extra, 0), 0x3f)
+        table.append((length << 26) | ((base + addr) & 0x03ffffff))
+        addr += sum(blocklens[k:k+2])
+    end = padding + 1 if padding is not None else 0
+    table.append((end << 26) | ((base + addr) & 0x03ffffff))
+    return table
+
+def container_codes(instrdict, range_regs):
+    # magic/fcodes tables (see code_table()) that encode with the dictionary
+    # and range registers of an existing ALICE container. Instructions not
+    # in the dictionary go through the escape range (prefix 7) unencoded.
+    if range_regs[-1] < 16:
+        raise ValueError("escape range too short for 16-bit instructions")
+    magic = bytearray([range_regs[7] + 3]) * 0x10000
+    fcodes = [(7 << range_regs[7]) | instr_idx for instr_idx in range(0x10000)]
+    indexes = []
+    for s, r in enumerate(range_regs[0:-1]):
+        indexes += [(s, r, i) for i in range(1 << r)]
+    # Last occurrence first, so the lowest dictionary index wins
+    for i in range(min(len(instrdict), len(indexes)) - 1, -1, -1):
+        s, r, idx = indexes[i]
+        magic[ instrdict[i] ] = r + 3
+        fcodes[ instrdict[i] ] = (s << r) | idx
+    return magic, fcodes
+
+def changed_blocks(old, new, blocksize):
+    # Indexes of the blocks that differ, large chunks are compared first
+    changed = []
+    chunk = blocksize*1024
+    for c in range(0, len(new), chunk):
+        if old[c:c+chunk] == new[c:c+chunk]:
+            continue
+        for b in range(c, min(c+chunk, len(new)), blocksize):
+            if old[b:b+blocksize] != new[b:b+blocksize]:
+                changed.append(b // blocksize)
+    return changed
+
+def block_span(alice, b, nblocks):
+    # Start and end of compressed block b, relative to the compressed region.
+    # Even blocks start at their mapping table entry, odd blocks where the
+    # even block before them ends, which takes decoding that one block.
+    mapaddrs = alice['mapaddrs']
+    blocksize = alice['blocksize']
+    k = b // 2
+    start = mapaddrs[k] if k > 0 else 0
+    end = mapaddrs[k+1]
+    if b % 2 == 1 or b + 1 < nblocks:
+        data = alice['buff'][start:end]
+        decoded, bitptr = unalice.bitunpack(data, mapaddrs, alice['maplens'], alice['instrdict'], alice['range_regs'], blocksize, start, 2*k, 2*k+1)
+        if len(decoded) != blocksize:
+            raise ValueError("cannot locate block %d"%(b + b % 2))
+        middle = start + (bitptr >> 3)
+        if b % 2 == 1:
+            start = middle
+        else:
+            end = middle
+    return start, end
+
+def patch_container(data, patched, original=None):
+    # Re-encode only the blocks of the decompressed image that differ
+    # between original and patched, with the dictionary and range registers
+    # of the ALICE container in data, and shift everything after them.
+    # Without original, the container is decoded to find the changes.
+    alice = unalice.parse_alice(data)
+    blocksize = alice['blocksize']
+    blockinstrs = blocksize // 2
+    base = alice['base']
+
+    new = bytearray(patched)
+    translate_bl_blx(new)
+    if original is not None:
+        old = bytearray(original)
+        translate_bl_blx(old)
+    else:
+        old = unalice.bitunpack(alice['buff'], alice['mapaddrs'], alice['maplens'], alice['instrdict'], alice['range_regs'], blocksize)[0]
+    if len(old) != len(new):
+        raise ValueError("patched image is %d bytes, original %d bytes"%(len(new), len(old)))
+
+    nblocks = -(-len(new) // blocksize)
+    changed = changed_blocks(old, new, blocksize)
+    magic, fcodes = container_codes(alice['instrdict'], alice['range_regs'])
+
+    # Splice the re-encoded blocks into the compressed stream
+    buff = alice['buff']
+    stream = bytearray()
+    cursor = 0
+    shifts = [] # (old address, shift of everything from there on)
+    newlens = {}
+    for b in changed:
+        start, end = block_span(alice, b, nblocks)
+        instrs = struct.unpack_from("<%dH"%(min(blockinstrs, (len(new) - b*blocksize) // 2)), new, b*blocksize)
+        packed, blocklens = pack_blocks(instrs, magic, fcodes, blockinstrs)
+        stream += buff[cursor:start]
+        stream += packed
+        cursor = end
+        shifts.append((end, len(stream) - end))
+        newlens[b] = blocklens[0]
+        log.info("re-encoded block %d, %d -> %d bytes", b, end - start, len(packed))
+    if changed and changed[-1] == nblocks - 1:
+        # Whether a tail byte follows depends on the new last block
+        stream += tail_byte(instrs, magic, blockinstrs)
+    else:
+        stream += buff[cursor:]
+    delta = len(stream) - len(buff)
+
+    # Rewrite the mapping table, addresses after a changed block move and
+    # the length of a changed even block is updated, as is the padding in
+    # the end entry if the last block changed
+    extra = ((3*blockinstrs) >> 3) + 1
+    table = array('I', alice['rawmappings'])
+    shift = 0
+    s = 0
+    for k in range(len(table)):
+        addr = alice['mapaddrs'][k] if k > 0 else 0
+        while s < len(shifts) and shifts[s][0] <= addr:
+            shift = shifts[s][1]
+            s += 1
+        length = table[k] >> 26
+        if 2*k in newlens and k < len(table) - 1:
+            length = min(max(newlens[2*k] - extra, 0), 0x3f)
+        elif k == len(table) - 1 and changed and changed[-1] == nblocks - 1:
+            length = last_padding(instrs, magic, blockinstrs) + 1
+        table[k] = (length << 26) | ((base + addr + shift) & 0x03ffffff)
+    if sys.byteorder == 'big':
+        table.byteswap()
+
+    header = bytearray(data[0:alice['compressed_offset']])
+    mapping_addr, dict_addr = struct.unpack_from("<LL", header, 12)
+    struct.pack_into("<LL", header, 12, mapping_addr + delta, dict_addr + delta)
+
+    out = header + stream + table.tobytes()
+    out += data[alice['dict_offset']:alice['filesize']]
+    return out, changed
+
+class AliceEncoder:
+    '''
+    Encoder for uncompressed ALICE images (ALICE.bin).
+
+    encode() translates, builds the dictionary and packs a bytes-like image
+    and returns the results; patch() re-encodes a patched image against an
+    existing ALICE component. Nothing is written to disk and no state is
+    kept between calls. With jobs > 1, blocks are packed in a process pool.
+    bits are the range registers, with optimize the ones giving the
+    smallest image are searched for instead. Given a unalice.Stats, the
+    stages of each encode are timed and the symbols counted.
+    '''
+
+    def __init__(self, base=0, jobs=1, blockinstrs=0x20, bits=range_bits, optimize=False, stats=None):
+        self.base = base
+        self.jobs = jobs
+        self.blockinstrs = blockinstrs
+        self.bits = bits
+        self.optimize = optimize
+        self.stats = stats
+
+    def translate(self, plain):
+        # Translated copy of plain and its instructions. Raises ValueError
+        # if plain holds no instruction, a trailing odd byte is dropped.
+        if len(plain) < 2:
+            raise ValueError("no instructions to encode")
+        if len(plain) % 2:
+            log.warning("odd length %d bytes, the last byte is dropped", len(plain))
+        with unalice.stage(self.stats, 'translate'):
+            buff = bytearray(plain)
+            translate_bl_blx(buff)
+            values = le_instrs(buff)
+        return buff, values
+
+    def choose_tables(self, values, tables=None):
+        # Range registers and the magic and fshist tables for the
+        # instructions in values, see encode()
+        stats = self.stats
+        with unalice.stage(stats, 'histogram'):
+            shist = histogram(values)
+        nblocks = -(-len(values) // self.blockinstrs)
+        bits = self.bits
+        candidates = [(predict_size(bits, shist, nblocks), bits)]
+        if self.optimize and tables is None:
+            with unalice.stage(stats, 'range search'):
+                candidates = optimize_range_bits(shist, nblocks) + candidates
+                candidates = rank_by_packing(values, candidates, shist, self.blockinstrs)
+            bits = candidates[0][1]
+        with unalice.stage(stats, 'dictionary'):
+            magic, fshist = make_dictionary(values, bits, shist)
+        packmagic, packhist = tables if tables is not None else (magic, fshist)
+        if stats is not None:
+            stats.symbols = symbol_counts(shist, packmagic, packhist)
+            stats.count('instructions', len(values))
+            stats.count('blocks', nblocks)
+            stats.count('distinct_instructions', len(shist))
+        return {'range_bits': bits, 'candidates': candidates, 'magic': magic, 'fshist': fshist,
+            'packmagic': packmagic, 'packhist': packhist}
+
+    def encode(self, plain, tables=None):
+        # Returns a dict: translated image, range registers (range_bits),
+        # candidates tried with their size (predicted, packed with optimize),
+        # generated dictionary
+        # (magic and fshist, as magic.bin and before_encode.bin), packed
+        # blocks, their lengths (blocklens), the mapping table (little
+        # endian), dictionary and header.
+        # tables is (magic, fshist) from ALICE.exe to pack with instead,
+        # these must use the range registers in bits.
+        buff, values = self.translate(plain)
+        result = self.choose_tables(values, tables)
+        packmagic = result.pop('packmagic')
+        packhist = result.pop('packhist')
+
+        with unalice.stage(self.stats, 'bitpack'):
+            if self.jobs > 1:
+                packed, blocklens = parallel_pack(values, packmagic, packhist, self.jobs, self.blockinstrs)
             else:
-                # shift imm11 left 11 bits, add lower bits from imm10 + sign
-                # multiply by two, add 2
-                v10 = 2 * (ptr + ((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff)) + 0x00000002
-
-#            print("-translated type 0x%04x from 0x%08x to 0x%08x"%(upbits, ((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff), v10))
-#            print("%d 0x%08x"%(ptr,((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff)))
-
-            # reassemble branch target
-            instr = (v10 >> 0x0c) & 0x7ff | 0xf000 # high bits
-            instr2 = (v10 >> 1) & 0x7ff | upbits   # low bits
-
-#            print("-translated 0x%04x to 0x%04x at 0x%x, diff = %d"%(buff[ptr*2] | buff[ptr*2+1] << 8, instr, ptr*2, (buff[ptr*2] | buff[ptr*2+1] << 8) - instr))
-            buff[ptr*2] = instr & 0xff
-            buff[ptr*2+1] = (instr >> 8) & 0xff
-#            print("-translated 0x%04x to 0x%04x at 0x%x, diff = %d"%(buff[ptr*2+2] | buff[ptr*2+3] << 8, instr2, ptr*2+2, (buff[ptr*2+2] | buff[ptr*2+3] << 8) - instr2))
-            buff[ptr*2+2] = instr2 & 0xff
-            buff[ptr*2+3] = (instr2 >> 8) & 0xff
-
-            ptr += 1
-        ptr += 1
-
-    print("translated %d bl and %d blx instructions"%(bl_count*2, blx_count*2))
-
-def bitpack(length, instr):
-    print("in bitpack 0x%02x 0x%08x"%(length, instr))
-    global buff, length_remain, ptr, count
-
-    instr_part = instr & 0xff
-    if length != 0:
-        if length > 8:
-            bitpack(length - 8, instr >> 8)
-            length = 8
-
-        length_part = length - length_remain - 1
-        print("length_part: %d = %d - %d - 1"%(length_part, length, length_remain))
-
-        if length_part < 0:
-            # shift left
-            print("shifting 0x%02x << %d = 0x%02x"%(instr_part, -length_part, (instr_part << -length_part) & 0xff))
-            print("%d b %02x | %02x -> %02x"%(ptr, buff[ptr], (instr_part << -length_part) & 0xff, (buff[ptr] | (instr_part << -length_part) & 0xff) & 0xff))
-            buff[ptr] |= (instr_part << -length_part) & 0xff
-            print("length_remain: %d = %d - %d"%(length_remain - length, length_remain, length))
-            length_remain -= length
-        elif length_part == 0:
-            # no shift
-            print("no shift 0x%02x"%(instr_part))
-            print("%d a %02x | %02x -> %02x"%(ptr, buff[ptr], instr_part, (buff[ptr] | instr_part) & 0xff))
-            buff[ptr] |= instr_part
-            ptr += 1
-            buff.append(0x00)
-            print("bitpack 1st buff.append")
-            length_remain = 7
-            print("length_remain: 7")
-        elif length_part > 0:
-            # shift right
-            print("shifting 0x%02x >> %d = 0x%02x"%(instr_part, length_part, (instr_part >> length_part) & 0xff))
-            print("%d c %02x | %02x -> %02x"%(ptr, buff[ptr], (instr_part >> length_part) & 0xff, (buff[ptr] | (instr_part >> length_part)) & 0xff))
-            buff[ptr] |= (instr_part >> length_part) & 0xff
-            ptr += 1
-            buff.append(0x00)
-            print("bitpack 2nd buff.append")
-            # shift left into new byte
-            print("shifting 0x%02x << %d = 0x%02x"%(instr_part, 8 - length_part, instr_part  << ((8 - length_part) & 0xff) & 0xff))
-            print("%d d %02x | %02x -> %02x"%(ptr, buff[ptr], instr_part  << (8 - length_part & 0xff) & 0xff, (buff[ptr] | instr_part  << (8 - length_part & 0xff) & 0xff) & 0xff))
-            buff[ptr] |= instr_part  << ((8 - length_part) & 0xff) & 0xff
-            length_remain = 7 - length_part
-            print("length_remain: %d = 7 - %d"%(length_remain, length_part))
-
-# Read ALICE.bin
-
-f = open(sys.argv[1], "rb")
-buff = bytearray(f.read())
-f.close()
-
-# Translate BL and BLX instructions
-ptr = 0
-translate_bl_blx()
-
-f = open("translated-py.bin", "wb")
-f.write(buff)
-f.close()
-
-# Generate histogram
-# Need to make sure it is sorted in the same way ALICE.exe sorts, that being
-# that first by frequency, then for instructions in the same frequency bin,
-# possibly by instruction value, first location in ALICE.bin, or something
-# else? Most likely ALICE.exe gets the order from the way the BST is
-# traversed.
-
-# Construct fake ALICE.bin with a desired histogram and try to match
-# the output.
-instrs=[bytes(buff[i*2:i*2+2]) for i in range(int(len(buff)/2))]
-hist=Counter(instrs)
-shist=sorted(hist.items(), key=lambda x: (-x[1], x[0]))
-shist_f=[freq for instr,freq in shist]
-shist=[instr for instr,freq in shist]
-
-# Generate magic vector, funked instructions dictionary (before_encode.bin)
-range_regs = [0x0, 0x10, 0x50, 0xd0, 0x1d0, 0x3d0, 0xbd0, 0x1bd0]
-#range_regs = [0x0, 0x02, 0x06, 0x0a, 0x0e, 0x12, 0x16, 0x1e]
-codes = [0x07, 0x09, 0x0A, 0x0B, 0x0C, 0x0E, 0x0F, 0x13]
-starts = [0x0, 0x40, 0x100, 0x300, 0x800, 0x2800, 0x6000, 0x70000]
-
-magic = bytearray(0x10000)
-fshist = dict()
-
-for r in range(len(range_regs)-1):
-    instrnr = 0
-    for i in range(range_regs[r], range_regs[r+1]):
-        instr_idx = struct.unpack("<H", shist[i])[0]
-        print("0x%02x 0x%04x 0x%08x %d %d"%(codes[r], instr_idx, (instrnr | starts[r]), shist_f[i], i))
-        # Magic
-        magic[ instr_idx ] = codes[r]
-        # Instr
-        fshist[ instr_idx ] = instrnr | starts[r]
-        instrnr += 1
-
-offset = len(range_regs)-1
-for i in range(range_regs[offset], len(hist)):
-    instr_idx = struct.unpack("<H", shist[i])[0]
-    print("0x%02x 0x%04x 0x%08x %d %d"%(codes[offset], instr_idx, (instr_idx | starts[offset]), shist_f[i], i))
-    # Magic
-    magic[ instr_idx ] = codes[offset]
-    fshist[ instr_idx ] = instr_idx | starts[offset]
-
-f=open("magic-py.bin", "wb")
-f.write(magic)
-f.close()
-
-f=open("before_encode-py.bin", "wb")
-for l,v in fshist.items():
-    f.seek(l*4)
-    f.write(struct.pack("<L", v))
-
-f.close()
-
-# Try to encode!
-
-if len(sys.argv) == 4:
-    f=open(sys.argv[2], "rb")
+                packed, blocklens = pack_blocks(values, packmagic, code_table(packmagic, packhist), self.blockinstrs)
+                packed += tail_byte(values, packmagic, self.blockinstrs)
+
+        with unalice.stage(self.stats, 'mapping table'):
+            table = mapping_table(blocklens, self.base, self.blockinstrs, last_padding(values, packmagic, self.blockinstrs))
+        if sys.byteorder == 'big':
+            table.byteswap()
+        with unalice.stage(self.stats, 'dictionary'):
+            entries = dictionary(packmagic, packhist)
+        if sys.byteorder == 'big':
+            entries.byteswap()
+        header = make_header(result['range_bits'], self.base, len(packed), 4*len(table), self.blockinstrs)
+        result.update({'translated': buff, 'packed': packed, 'blocklens': blocklens,
+            'mapping': table.tobytes(), 'dictionary': entries.tobytes(), 'header': header})
+        return result
+
+    def write(self, f, plain, tables=None, version=2):
+        # Encode plain into a complete ALICE_2 (or ALICE_1) component,
+        # streamed to the seekable file f. Returns the range registers,
+        # candidates and the length of each part.
+        buff, values = self.translate(plain)
+        del buff
+        result = self.choose_tables(values, tables)
+        lengths = write_container(f, values, result['packmagic'], result['packhist'], result['range_bits'],
+            self.base, self.jobs, self.blockinstrs, version, self.stats)
+        return {'range_bits': result['range_bits'], 'candidates': result['candidates'], 'lengths': lengths}
+
+    def patch(self, data, patched, original=None):
+        # See patch_container()
+        return patch_container(data, patched, original)
+
+def read_tables(magicfile, fshistfile):
+    # magic and before_encode tables generated by ALICE.exe
+    f=open(magicfile, "rb")
     magic=bytearray(f.read())
     f.close()
 
-    fshist=dict()
-    f=open(sys.argv[3], "rb")
-    for instr_idx in range(0x10000):
-        instr = struct.unpack("<L", f.read(4))[0]
-        fshist[ instr_idx ] = instr
+    f=open(fshistfile, "rb")
+    fshist = le_instrs(f.read(4*0x10000), 'I')
+    f.close()
+    return magic, fshist
+
+def patch(alicefile, args):
+    f = open(alicefile, "rb")
+    data = f.read()
+    f.close()
+    f = open(args[0], "rb")
+    patched = f.read()
+    f.close()
+    original = None
+    if len(args) == 2:
+        f = open(args[1], "rb")
+        original = f.read()
+        f.close()
+
+    try:
+        out, changed = AliceEncoder().patch(data, patched, original)
+    except ValueError as e:
+        log.error("%s, quitting.", e)
+        sys.exit(1)
+    log.info("%d blocks changed", len(changed))
+
+    f = open("alice-patched-py", "wb")
+    length = f.write(out)
+    log.info("wrote alice-patched-py %d bytes", length)
     f.close()
 
-ptr = 0
-length_remain = 0x07
-buff = bytearray([0x00])
-count = 0
-for instr in instrs:
-    instr_idx = struct.unpack("<H", instr)[0]
-    print("instr_idx %d 0x%04x total %d"%(instr_idx, instr_idx, len(fshist)))
-    bitnum = magic[ instr_idx ]
-    finstr = fshist [ instr_idx ]
-    print("calling bitpack 0x%02x 0x%08x"%(bitnum, finstr))
-    bitpack(bitnum, finstr)
-
-    count += 1
-    if count % 0x20 == 0:
-        if count % 0x40 == 0:
-            print("hit instruction blocksize 0x40 at ptr 0x%08x"%(ptr))
-        if count > 0 and length_remain != 0x07:
-            length_remain = 0x07
-            ptr += 1
-            buff.append(0x00)
-            print("buff.append")
-            # Do some stuff here...
-
-# TODO Need to add some padding here
-
-f=open("alice-py", "wb")
-len = f.write(buff)
-print("wrote alice-py %d bytes"%len)
-f.close()
+def write_stats(stats, statsfile, bits, plain_size, compressed_size):
+    # JSON report of an instrumented run, - for stdout
+    report = stats.as_dict()
+    report.update({
+        'plain_size': plain_size,
+        'compressed_size': compressed_size,
+        'range_bits': list(bits),
+    })
+    f = sys.stdout if statsfile == "-" else open(statsfile, "w")
+    json.dump(report, f, indent=2)
+    f.write("\n")
+    if f is not sys.stdout:
+        f.close()
+
+def usage():
+    print("usage: alice.py [-v] [-r] [-j N] [-b base] <ALICE.bin> [magic.bin before_encode.bin]")
+    print("       alice.py [-v] -p <ALICE> <patched.bin> [original.bin]")
+    print("       -v debug output for every instruction (slow)")
+    print("       -j, --jobs N pack blocks in N processes (default 1)")
+    print("       -b address the compressed data is loaded at, for the mapping table (default 0)")
+    print("       -r choose the range registers that give the smallest output")
+    print("       -p re-encode only the blocks of ALICE that differ in patched.bin (decoded, as")
+    print("          alice-py.bin), writes alice-patched-py. original.bin saves decoding ALICE")
+    print("       --output file write the complete ALICE component to file, streamed as blocks")
+    print("          are packed, instead of the separate parts")
+    print("       --alice1 with --output, write an ALICE_1 component (64 byte blocks)")
+    print("       --stats file write the time spent in each stage and symbol counts as JSON")
+    print("          to file (- for stdout)")
+    print("       magic.bin before_encode.bin are tables from ALICE.exe to encode with")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "vrj:b:p:", ["jobs=", "output=", "alice1", "stats="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    level = logging.INFO
+    jobs = 1
+    base = 0
+    patchfile = None
+    optimize = False
+    output = None
+    version = 2
+    statsfile = None
+    for o, a in opts:
+        if o == "-v":
+            level = logging.DEBUG
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "-b":
+            base = int(a, 0)
+        elif o == "-p":
+            patchfile = a
+        elif o == "-r":
+            optimize = True
+        elif o == "--output":
+            output = a
+        elif o == "--alice1":
+            version = 1
+        elif o == "--stats":
+            statsfile = a
+    # With the stats on stdout, the log goes to stderr
+    logging.basicConfig(format="%(message)s", level=level, stream=sys.stderr if statsfile == "-" else sys.stdout)
+
+    stats = None
+    if statsfile is not None:
+        stats = unalice.Stats()
+
+    if patchfile is not None:
+        if len(args) not in (1, 2):
+            usage()
+            sys.exit(1)
+        patch(patchfile, args)
+        return
+    if len(args) not in (1, 3):
+        usage()
+        sys.exit(1)
+
+    # Read ALICE.bin
+    with unalice.stage(stats, 'read'):
+        f = open(args[0], "rb")
+        plain = f.read()
+        f.close()
+    if len(plain) < 2:
+        log.error("%s holds no instructions, quitting.", args[0])
+        sys.exit(1)
+
+    tables = None
+    if len(args) == 3:
+        tables = read_tables(args[1], args[2])
+
+    if tables is not None and optimize:
+        log.info("tables given, keeping range registers %s", range_bits)
+    if output is not None:
+        f = open(output, "wb")
+        result = AliceEncoder(base, jobs, optimize=optimize, stats=stats).write(f, plain, tables, version)
+        with unalice.stage(stats, 'write'):
+            f.close()
+        for size, bits in result['candidates']:
+            log.info("range registers %s: %s %d bytes", bits, "packed" if optimize and tables is None else "predicted", size)
+        log.info("using range registers %s", result['range_bits'])
+        lengths = result['lengths']
+        size = sum([lengths[part] for part in ('header', 'compressed', 'mapping', 'dictionary')])
+        log.info("wrote %s %d bytes: %d blocks in %d bytes, %d byte mapping table, %d byte dictionary", output,
+            size, lengths['blocks'], lengths['compressed'], lengths['mapping'], lengths['dictionary'])
+        if stats is not None:
+            write_stats(stats, statsfile, result['range_bits'], len(plain), size)
+        return
+    result = AliceEncoder(base, jobs, optimize=optimize, stats=stats).encode(plain, tables)
+    for size, bits in result['candidates']:
+        log.info("range registers %s: %s %d bytes", bits, "packed" if optimize and tables is None else "predicted", size)
+    log.info("using range registers %s", result['range_bits'])
+
+    with unalice.stage(stats, 'write'):
+        f = open("translated-py.bin", "wb")
+        f.write(result['translated'])
+        f.close()
+
+        f=open("magic-py.bin", "wb")
+        f.write(result['magic'])
+        f.close()
+
+        table = array('I', result['fshist'])
+        if sys.byteorder == 'big':
+            table.byteswap()
+        f=open("before_encode-py.bin", "wb")
+        f.write(table.tobytes())
+        f.close()
+
+        f=open("alice-py", "wb")
+        length = f.write(result['packed'])
+        log.info("wrote alice-py %d bytes", length)
+        f.close()
+
+        f=open("mapping-py.bin", "wb")
+        f.write(result['mapping'])
+        f.close()
+        log.info("wrote mapping-py.bin %d entries for %d blocks", len(result['mapping']) // 4, len(result['blocklens']))
+
+        f=open("dictionary-py.bin", "wb")
+        f.write(result['dictionary'])
+        f.close()
+        log.info("wrote dictionary-py.bin %d entries", len(result['dictionary']) // 2)
+
+        f=open("header-py.bin", "wb")
+        f.write(result['header'])
+        f.close()
+    if stats is not None:
+        write_stats(stats, statsfile, result['range_bits'], len(plain),
+            len(result['header']) + len(result['packed']) + len(result['mapping']) + len(result['dictionary']))
+
+if __name__ == '__main__':
+    main()
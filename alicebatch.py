@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+'''
+Alice batch
+
+Decode every ALICE component in a directory of firmware images, or in a
+manifest listing one image per line, across a process pool.
+
+Each input is either an ALICE component or a full firmware dump, in which case
+the first ALICE partition found by fwscan.py is decoded. Every image gets its
+own output directory holding alice-py.bin and alice-translated-py.bin, named
+after the input file. A JSON summary of the run (header fields, range
+registers, block counts, timing and errors) is written to summary.json in the
+output directory. An image that fails to decode is recorded in the summary and
+does not stop the batch. With --cache, images decoded before (here or by
+unalice.py) are read from the cache.
+
+Requirements:
+    python3
+
+Copyright 2018 Donn Morrison donn.morrison@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import json
+import time
+import getopt
+import multiprocessing
+
+import fwscan
+import unalice
+
+def find_images(path):
+    # All files below a directory, or the files listed in a manifest (blank
+    # lines and # comments are skipped, relative paths are relative to the
+    # manifest)
+    if os.path.isdir(path):
+        images = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            images += [os.path.join(root, name) for name in sorted(files)]
+        return images
+    images = []
+    f = open(path, "r")
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            images.append(os.path.join(os.path.dirname(path), line))
+    f.close()
+    return images
+
+def output_dirs(images, outdir):
+    # One directory per image, named after the file, numbered on collision
+    dirs = []
+    used = set()
+    for image in images:
+        name = os.path.basename(image)
+        n = 1
+        while name in used:
+            n += 1
+            name = "%s-%d"%(os.path.basename(image), n)
+        used.add(name)
+        dirs.append(os.path.join(outdir, name))
+    return dirs
+
+def open_image(image):
+    # ALICE component, or the first ALICE partition of a firmware dump
+    data = unalice.map_file(image)
+    try:
+        return unalice.AliceHeader(data, 0, image)
+    except ValueError:
+        pass
+    for part in fwscan.scan(data):
+        if part['name'].startswith('ALICE'):
+            return unalice.AliceHeader(data, part['offset'], image)
+    raise ValueError("no ALICE partition found")
+
+def decode_image(job):
+    image, imagedir, translate, auto, cachedir = job
+    summary = {'file': image, 'output': imagedir}
+    t = time.perf_counter()
+    try:
+        header = open_image(image)
+        if auto:
+            found = unalice.detect(header.data, header.offset)
+            header = unalice.AliceHeader(header.data, header.offset, image, found['header_size'], found['blocksize'])
+            translate = translate and found['translate']
+            summary['detected'] = found
+        summary.update({
+            'offset': header.offset,
+            'magic': header.magic.decode(),
+            'header_size': header.header_size,
+            'base': header.base,
+            'blocksize': header.blocksize,
+            'range_regs': header.range_regs,
+            'translate': translate,
+            'mapping_entries': len(header.mapaddrs),
+            'dictionary_entries': len(header.instrdict),
+            'compressed_size': len(header.buff),
+        })
+
+        cache = None
+        if cachedir is not None:
+            cache = unalice.DecodeCache(cachedir[0], cachedir[1])
+        decoder = unalice.AliceDecoder(header, translate, 1, cache)
+        result = decoder.decode()
+        mismatches = decoder.verify(result['boundaries'])
+
+        os.makedirs(imagedir, exist_ok=True)
+        f = open(os.path.join(imagedir, "alice-translated-py.bin"), "wb")
+        f.write(result['decoded'])
+        f.close()
+        f = open(os.path.join(imagedir, "alice-py.bin"), "wb")
+        f.write(result['image'])
+        f.close()
+
+        summary.update({
+            'blocks': len(result['boundaries']),
+            'block_mismatches': len(mismatches),
+            'decoded_size': len(result['image']),
+            'bl': result['bl']*2,
+            'blx': result['blx']*2,
+            'cached': result['cached'],
+        })
+    except Exception as e: # one bad image must not stop the batch
+        summary['error'] = "%s: %s"%(type(e).__name__, e)
+    summary['seconds'] = round(time.perf_counter() - t, 3)
+    return summary
+
+def usage():
+    print("usage: alicebatch.py [-a] [-t] [-j N] [-x outdir] [--cache dir] <directory|manifest>")
+    print("       -a detect header layout and bl/blx translation per image, see unalice.py")
+    print("       -t disable bl/blx addr translation")
+    print("       -j, --jobs N number of images decoded in parallel (default %d)"%(os.cpu_count() or 1))
+    print("       -x output directory (default alice-batch-py)")
+    print("       --cache dir reuse images decoded before, see unalice.py")
+    print("       --cache-size MB size of the cache (default 1024)")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "atj:x:", ["jobs=", "cache=", "cache-size="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+
+    translate = True
+    auto = False
+    jobs = os.cpu_count() or 1
+    outdir = "alice-batch-py"
+    cachedir = None
+    cachesize = 1024
+    for o, a in opts:
+        if o == "-t":
+            translate = False
+        elif o == "-a":
+            auto = True
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "-x":
+            outdir = a
+        elif o == "--cache":
+            cachedir = a
+        elif o == "--cache-size":
+            cachesize = int(a)
+
+    if cachedir is not None:
+        cachedir = (cachedir, cachesize << 20)
+    images = find_images(args[0])
+    dirs = output_dirs(images, outdir)
+    os.makedirs(outdir, exist_ok=True)
+    print("decoding %d images with %d jobs"%(len(images), jobs))
+
+    t = time.perf_counter()
+    results = []
+    with multiprocessing.Pool(jobs) as pool:
+        for summary in pool.imap_unordered(decode_image, [(image, imagedir, translate, auto, cachedir) for image, imagedir in zip(images, dirs)]):
+            if 'error' in summary:
+                print("--- %s failed: %s"%(summary['file'], summary['error']))
+            else:
+                print("--- %s: %d bytes in %.3f s"%(summary['file'], summary['decoded_size'], summary['seconds']))
+            results.append(summary)
+    results.sort(key=lambda summary: summary['file'])
+
+    failed = len([summary for summary in results if 'error' in summary])
+    run = {
+        'input': args[0],
+        'translate': translate,
+        'jobs': jobs,
+        'images': len(results),
+        'failed': failed,
+        'seconds': round(time.perf_counter() - t, 3),
+        'results': results,
+    }
+    f = open(os.path.join(outdir, "summary.json"), "w")
+    json.dump(run, f, indent=2)
+    f.close()
+    print("decoded %d images, %d failed, summary in %s"%(len(results) - failed, failed, os.path.join(outdir, "summary.json")))
+
+if __name__ == '__main__':
+    main()
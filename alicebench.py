@@ -0,0 +1,446 @@
+#!/usr/bin/python3
+
+'''
+Alice benchmark
+
+Time the ALICE decoder on a compressed ALICE component and report throughput
+in MB/s of compressed input and decompressed output.
+
+If bitstring is installed, the original BitArray based decoder is timed as
+well and its output compared against the integer bit reader in unalice.py.
+
+With -e, time the encoder stages on an uncompressed ALICE.bin instead, and
+compare the bit writer in alice.py against the original recursive bitpack.
+
+With -s, generate synthetic Thumb images, encode them with alice.py and
+decode them again with unalice.py, all in memory. Each stage (translation,
+histogram, dictionary, packing, unpacking, untranslation) is timed, and the
+decoded image is compared against the input block by block. --json writes
+the results for each image in machine-readable form.
+
+Requirements:
+    python3
+    bitstring for python (optional, reference decoder only)
+
+Copyright 2018 Donn Morrison donn.morrison@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import io
+import sys
+import json
+import math
+import time
+import random
+import struct
+import getopt
+import contextlib
+from array import array
+
+import alice
+import unalice
+
+def bitunpack_bitarray(buff, mapaddrs, maplens, instrdict, range_regs, blocksize):
+    # Reference decoder, BitArray slicing as in the original unalice.py
+    from bitstring import BitArray
+    bitbuff = BitArray(bytes(buff))
+    mappings = list(zip(mapaddrs, maplens))
+    alicebin = bytearray()
+    bitptr = 0
+    numblocks = 0
+    byteswritten = 0
+    matchedblocks = 0
+    lastblock = False
+    lastinstr = None
+
+    starts = range(0,8) # each 3 bits long
+    prefixes = [start << r for start,r in zip(starts, range_regs)]
+    lengths = [r + 3 for r in range_regs]
+    range_regs_pow = [0] + [int(math.pow(2, r)) for r in range_regs[0:-1]]
+
+    while bitptr < ((mappings[-1])[0] + mappings[-1][1])*8 and bitptr < len(bitbuff): # mapping table addr + len
+        if blocksize != 0 and (byteswritten % blocksize) == 0:
+            if bitptr%8 != 0:
+                bitptr = bitptr + (8 - (bitptr%8))
+            if numblocks%2 == 0:
+                if int(bitptr/8) in [m for m,l in mappings]:
+                    matchedblocks += 1
+            numblocks += 1
+            if (numblocks/2) / float(len(mappings)-1) > 0.999: # Somewhere near the end?
+                lastblock = True
+
+        for s,l in zip(starts,lengths):
+            if bitbuff[bitptr:bitptr+3].uint == s:
+                instr = bitbuff[bitptr:bitptr+l].uint
+                if (lastblock and bin(bitbuff[bitptr:bitptr+64].uint)[2:].count('1') < 2):
+                    return alicebin
+                if (lastblock and instr == 1 and s == 0 and lastinstr == 0xeaff):
+                    return alicebin
+                if s != 0x7:
+                    low = sum(range_regs_pow[0:starts.index(s)+1])
+                    instridx = instr - prefixes[starts.index(s)]
+                    originstr = instrdict[low + instridx]
+                else:
+                    originstr = instr & 0xffff
+                lastinstr = originstr
+                decomp = struct.pack("<H", originstr)
+                byteswritten += len(decomp)
+                alicebin += bytearray(decomp)
+                bitptr += l
+                break
+    return alicebin
+
+def bitpack_recursive(instrs, magic, fshist):
+    # Reference encoder, byte at a time recursive bitpack as in the original
+    # alice.py
+    state = {'buff': bytearray([0x00]), 'ptr': 0, 'length_remain': 0x07}
+
+    def bitpack(length, instr):
+        buff = state['buff']
+        instr_part = instr & 0xff
+        if length != 0:
+            if length > 8:
+                bitpack(length - 8, instr >> 8)
+                length = 8
+            length_part = length - state['length_remain'] - 1
+            if length_part < 0:
+                buff[state['ptr']] |= (instr_part << -length_part) & 0xff
+                state['length_remain'] -= length
+            elif length_part == 0:
+                buff[state['ptr']] |= instr_part
+                state['ptr'] += 1
+                buff.append(0x00)
+                state['length_remain'] = 7
+            elif length_part > 0:
+                buff[state['ptr']] |= (instr_part >> length_part) & 0xff
+                state['ptr'] += 1
+                buff.append(0x00)
+                buff[state['ptr']] |= instr_part  << ((8 - length_part) & 0xff) & 0xff
+                state['length_remain'] = 7 - length_part
+
+    count = 0
+    for instr_idx in instrs:
+        bitpack(magic[ instr_idx ], fshist[ instr_idx ])
+        count += 1
+        if count % 0x20 == 0 and state['length_remain'] != 0x07:
+            state['length_remain'] = 0x07
+            state['ptr'] += 1
+            state['buff'].append(0x00)
+    return state['buff']
+
+def timeit(fn, args, repeat):
+    best = None
+    for i in range(repeat):
+        # The decoders print progress, keep it out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = time.perf_counter()
+            result = fn(*args)
+            t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return best, result
+
+def report(name, seconds, insize, outsize):
+    print("%-11s %8.3f s  %8.3f MB/s in  %8.3f MB/s out"%(name, seconds,
+        insize/seconds/1e6, outsize/seconds/1e6))
+
+def bench_encoder(alicebin, repeat):
+    f = open(alicebin, "rb")
+    plain = f.read()
+    f.close()
+    size = len(plain)
+
+    t, result = timeit(lambda: alice.translate_bl_blx(bytearray(plain)), (), repeat)
+    report("translate", t, size, size)
+    buff = bytearray(plain)
+    alice.translate_bl_blx(buff)
+
+    values = alice.le_instrs(buff)
+    t, (magic, fshist) = timeit(alice.make_dictionary, (values,), repeat)
+    report("dictionary", t, size, size)
+
+    t, packed = timeit(alice.bitpack, (values, magic, fshist), repeat)
+    print("uncompressed %d bytes, compressed %d bytes"%(size, len(packed)))
+    report("bitpack", t, size, len(packed))
+
+    tref, refpacked = timeit(bitpack_recursive, (values, magic, fshist), repeat)
+    report("recursive", tref, size, len(refpacked))
+    print("speedup %.1fx"%(tref/t))
+    if refpacked != packed:
+        print("MISMATCH: output differs from reference encoder")
+        sys.exit(1)
+    print("output identical to reference encoder")
+
+# Thumb instruction templates (fixed bits, mask of the operand bits) the
+# synthetic images are built from, roughly in order of how common they are
+# in firmware
+THUMB_TEMPLATES = [
+    (0x6800, 0x07ff), # ldr rd, [rn, #imm]
+    (0x6000, 0x07ff), # str rd, [rn, #imm]
+    (0x2000, 0x07ff), # movs rd, #imm
+    (0x4800, 0x07ff), # ldr rd, [pc, #imm]
+    (0x1c00, 0x01ff), # adds rd, rn, #imm3 (movs rd, rn)
+    (0x2800, 0x07ff), # cmp rn, #imm
+    (0xd000, 0x0dff), # b<cond>
+    (0x4600, 0x00ff), # mov rd, rm
+    (0x9800, 0x07ff), # ldr rd, [sp, #imm]
+    (0x9000, 0x07ff), # str rd, [sp, #imm]
+    (0x7800, 0x07ff), # ldrb rd, [rn, #imm]
+    (0x7000, 0x07ff), # strb rd, [rn, #imm]
+    (0x4000, 0x03ff), # alu rd, rm
+    (0x3000, 0x0fff), # adds/subs rd, #imm
+    (0x1800, 0x03ff), # adds/subs rd, rn, rm
+    (0x0000, 0x0fff), # lsls/lsrs rd, rm, #imm
+    (0xb500, 0x00ff), # push {..., lr}
+    (0xbd00, 0x00ff), # pop {..., pc}
+    (0xe000, 0x07ff), # b
+    (0x8800, 0x07ff), # ldrh rd, [rn, #imm]
+    (0x8000, 0x07ff), # strh rd, [rn, #imm]
+    (0xa800, 0x07ff), # add rd, sp, #imm
+    (0xb000, 0x00ff), # add/sub sp, #imm
+    (0x4700, 0x0078), # bx rm
+]
+
+def synth_image(size, seed=0, bl_density=0.05, literal_density=0.04):
+    # A synthetic ALICE.bin of size bytes: instructions drawn from a Zipf
+    # like distribution over a vocabulary built from THUMB_TEMPLATES, with
+    # bl_density of the instructions starting a BL/BLX pair to a target
+    # inside the image (one in ten a BLX) and literal_density of them a
+    # random 32-bit literal
+    rnd = random.Random(seed)
+    vocab = []
+    seen = set()
+    for rank in range(4096):
+        fixed, mask = THUMB_TEMPLATES[min(int(rnd.expovariate(0.15)), len(THUMB_TEMPLATES) - 1)]
+        instr = fixed | (rnd.getrandbits(16) & mask)
+        if instr not in seen:
+            seen.add(instr)
+            vocab.append(instr)
+    weights = [1.0/(rank + 1)**1.1 for rank in range(len(vocab))]
+
+    ninstrs = size//2
+    instrs = array('H', rnd.choices(vocab, weights, k=ninstrs))
+    ptr = 0
+    while ptr < ninstrs - 1:
+        r = rnd.random()
+        if r < bl_density:
+            off = (rnd.randrange(ninstrs) - ptr - 2) & 0x3fffff
+            upbits = 0xe800 if rnd.random() < 0.1 else 0xf800
+            instrs[ptr] = 0xf000 | (off >> 11)
+            instrs[ptr+1] = upbits | (off & (0x7fe if upbits == 0xe800 else 0x7ff))
+            ptr += 2
+        elif r < bl_density + literal_density:
+            instrs[ptr] = rnd.getrandbits(16)
+            instrs[ptr+1] = rnd.getrandbits(16)
+            ptr += 2
+        else:
+            ptr += 1
+    if sys.byteorder == 'big':
+        instrs.byteswap()
+    return instrs.tobytes() + bytes(size % 2)
+
+def diff_blocks(a, b, blocksize):
+    # Indices of the blocks of blocksize bytes that differ between a and b,
+    # past the end of the shorter one every block differs
+    return [k for k in range(-(-max(len(a), len(b)) // blocksize))
+        if a[k*blocksize:(k+1)*blocksize] != b[k*blocksize:(k+1)*blocksize]]
+
+def bench_roundtrip(size, seed, repeat, blockinstrs=0x20):
+    # Encode and decode a synthetic image in memory, timing every stage.
+    # Returns a dict of the results, see main()
+    plain = synth_image(size, seed)
+    blocksize = 2*blockinstrs
+    stages = {}
+
+    def stage(name, seconds, insize, outsize):
+        report(name, seconds, insize, outsize)
+        stages[name] = {
+            'seconds': round(seconds, 6),
+            'in_bytes': insize,
+            'out_bytes': outsize,
+            'in_mb_per_s': round(insize/seconds/1e6, 3),
+            'out_mb_per_s': round(outsize/seconds/1e6, 3),
+        }
+
+    t, translated = timeit(lambda: alice.translate_bl_blx(bytearray(plain)), (), repeat)
+    translated = bytearray(plain)
+    alice.translate_bl_blx(translated)
+    stage("translate", t, size, size)
+
+    values = alice.le_instrs(translated)
+    t, shist = timeit(alice.histogram, (values,), repeat)
+    stage("histogram", t, size, size)
+    t, (magic, fshist) = timeit(alice.make_dictionary, (values, alice.range_bits, shist), repeat)
+    stage("dictionary", t, size, size)
+
+    fcodes = alice.code_table(magic, fshist)
+    t, (packed, blocklens) = timeit(alice.pack_blocks, (values, magic, fcodes, blockinstrs), repeat)
+    stage("bitpack", t, size, len(packed))
+
+    # Assemble the container in memory and parse it as unalice.py would
+    f = io.BytesIO()
+    alice.write_container(f, values, magic, fshist, alice.range_bits, 0, 1, blockinstrs)
+    header = unalice.AliceHeader(f.getvalue())
+
+    boundaries = []
+    def unpack():
+        del boundaries[:]
+        return unalice.bitunpack(header.buff, header.mapaddrs, header.maplens, header.instrdict,
+            header.range_regs, header.blocksize, boundaries=boundaries)
+    t, (decoded, bitptr) = timeit(unpack, (), repeat)
+    stage("bitunpack", t, len(header.buff), len(decoded))
+
+    t, (bl, blx) = timeit(lambda: unalice.untranslate_bl_blx(bytearray(decoded)), (), repeat)
+    image = bytearray(decoded)
+    unalice.untranslate_bl_blx(image)
+    stage("untranslate", t, size, size)
+
+    # Instructions the decoder lost at the end of the stream
+    dropped = max(len(translated) - len(decoded), 0)//2
+
+    # Again with the range registers alice.py -r chooses, through the
+    # encoder and decoder classes
+    encoder = alice.AliceEncoder(blockinstrs=blockinstrs, optimize=True)
+    t, optimized = timeit(lambda: encoder.write(io.BytesIO(), plain), (), repeat)
+    g = io.BytesIO()
+    encoder.write(g, plain)
+    stage("encode -r", t, size, len(g.getvalue()))
+    optimized_image = unalice.AliceDecoder(unalice.AliceHeader(g.getvalue())).decode()['image']
+
+    mismatches = unalice.verify_blocks(header.blockstarts, boundaries)
+    translated_blocks = diff_blocks(decoded, translated, blocksize)
+    image_blocks = diff_blocks(image, plain, blocksize)
+    optimized_blocks = diff_blocks(optimized_image, plain, blocksize)
+    return {
+        'size': size,
+        'seed': seed,
+        'compressed_size': len(f.getvalue()),
+        'ratio': round(len(f.getvalue())/size, 4),
+        'blocks': len(boundaries),
+        'bl': bl*2,
+        'blx': blx*2,
+        'stages': stages,
+        'dropped_instrs': dropped,
+        'boundary_mismatches': len(mismatches),
+        'translated_mismatches': translated_blocks[:16],
+        'image_mismatches': image_blocks[:16],
+        'optimized_range_bits': optimized['range_bits'],
+        'optimized_size': len(g.getvalue()),
+        'optimized_mismatches': optimized_blocks[:16],
+        'ok': not dropped and not mismatches and not translated_blocks and not image_blocks and not optimized_blocks,
+    }
+
+def usage():
+    print("usage: alicebench.py [-n repeat] <ALICE>")
+    print("       alicebench.py [-n repeat] -e <ALICE.bin>")
+    print("       alicebench.py [-n repeat] -s KB[,KB...] [--seed N] [--json file]")
+    print("       -n number of timed runs per stage, best is reported (default 3)")
+    print("       -e benchmark the encoder on uncompressed ALICE.bin")
+    print("       -s round trip synthetic images of the given sizes in KB through the encoder")
+    print("          and decoder in memory, with the default range registers and those -r")
+    print("          chooses, exits 1 if any image does not decode to its input")
+    print("       --seed N seed of the first synthetic image (default 0), one more for each next size")
+    print("       --json file write the synthetic results as JSON (- for stdout)")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:es:", ["seed=", "json="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    repeat = 3
+    encode = False
+    sizes = None
+    seed = 0
+    jsonfile = None
+    for o, a in opts:
+        if o == "-n":
+            repeat = int(a)
+        elif o == "-e":
+            encode = True
+        elif o == "-s":
+            sizes = [int(kb) << 10 for kb in a.split(",")]
+        elif o == "--seed":
+            seed = int(a)
+        elif o == "--json":
+            jsonfile = a
+
+    if sizes is not None:
+        if args:
+            usage()
+            sys.exit(1)
+        results = []
+        out = sys.stderr if jsonfile == "-" else sys.stdout
+        with contextlib.redirect_stdout(out):
+            for n, size in enumerate(sizes):
+                print("--- synthetic image %d bytes, seed %d"%(size, seed + n))
+                result = bench_roundtrip(size, seed + n, repeat)
+                print("compressed %d bytes (%.1f%%), %d blocks, -r %s %d bytes, round trip %s"%(result['compressed_size'],
+                    100*result['ratio'], result['blocks'], result['optimized_range_bits'], result['optimized_size'],
+                    "ok" if result['ok'] else "FAILED"))
+                if not result['ok']:
+                    print("MISMATCH: %d instructions dropped, %d block boundaries, translated blocks %s, image blocks %s, -r image blocks %s"%(
+                        result['dropped_instrs'], result['boundary_mismatches'], result['translated_mismatches'],
+                        result['image_mismatches'], result['optimized_mismatches']))
+                results.append(result)
+        if jsonfile is not None:
+            run = {'repeat': repeat, 'python': sys.version.split()[0], 'results': results}
+            f = sys.stdout if jsonfile == "-" else open(jsonfile, "w")
+            json.dump(run, f, indent=2)
+            f.write("\n")
+            if f is not sys.stdout:
+                f.close()
+        if not all([result['ok'] for result in results]):
+            sys.exit(1)
+        return
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+
+    if encode:
+        bench_encoder(args[0], repeat)
+        return
+
+    alice = unalice.read_alice(args[0])
+    args = (alice['buff'], alice['mapaddrs'], alice['maplens'], alice['instrdict'], alice['range_regs'], alice['blocksize'])
+    insize = len(alice['buff'])
+
+    t, (buff, bitptr) = timeit(unalice.bitunpack, args, repeat)
+    print("compressed %d bytes, decompressed %d bytes"%(insize, len(buff)))
+    report("bitunpack", t, insize, len(buff))
+
+    try:
+        import bitstring
+    except ImportError:
+        print("bitstring not installed, skipping reference decoder")
+        return
+
+    tref, refbuff = timeit(bitunpack_bitarray, args, repeat)
+    report("bitarray", tref, insize, len(refbuff))
+    print("speedup %.1fx"%(tref/t))
+    # The reference guesses the end of the data from the last instructions,
+    # unalice.py takes it from the mapping table. Compare up to where both
+    # stop and report the tail separately.
+    common = min(len(refbuff), len(buff))
+    if refbuff[:common] != buff[:common]:
+        print("MISMATCH: output differs from reference decoder")
+        sys.exit(1)
+    print("output identical to reference decoder")
+    if len(refbuff) != len(buff):
+        print("reference decoder stops at %d bytes, bitunpack at %d bytes (end from the mapping table)"%(len(refbuff), len(buff)))
+
+if __name__ == '__main__':
+    main()
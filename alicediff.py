@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+'''
+Alice diff
+
+Report which parts of the decompressed image changed between two ALICE
+components, e.g. two firmware builds for the same device.
+
+If both components use the same range registers, blocksize and dictionary,
+identical compressed bytes decode to identical instructions. Runs of block
+pairs are then located through the mapping tables and compared by hash, and
+only the runs that differ are decoded. Otherwise both images are decoded in
+full, each across a process pool, and compared.
+
+Changed ranges are offsets into the decompressed image, as in alice-py.bin.
+Bytes past the end of the shorter image count as changed.
+
+Requirements:
+    python3
+
+Copyright 2018 Donn Morrison donn.morrison@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import json
+import time
+import getopt
+import hashlib
+
+import alicebatch
+import unalice
+
+def same_tables(a, b):
+    # Whether the compressed bytes of a and b decode the same way
+    return (a['range_regs'] == b['range_regs'] and a['blocksize'] == b['blocksize']
+        and a['instrdict'] == b['instrdict'])
+
+def changed_ranges(a, b, offset=0, blocksize=64):
+    # (start, end) of the bytes that differ between a and b, offset added.
+    # Compared a block at a time, bytes only within blocks that differ.
+    # Adjacent ranges are merged.
+    ranges = []
+    def add(start, end):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    common = min(len(a), len(b))
+    for pos in range(0, common, blocksize):
+        end = min(pos + blocksize, common)
+        if a[pos:end] == b[pos:end]:
+            continue
+        first = pos
+        while a[first] == b[first]:
+            first += 1
+        last = end
+        while a[last - 1] == b[last - 1]:
+            last -= 1
+        add(offset + first, offset + last)
+    if len(a) != len(b):
+        add(offset + common, offset + max(len(a), len(b)))
+    return ranges
+
+def run_hashes(alice, step):
+    # Hash of the compressed bytes of every run of step block pairs
+    npairs = max(len(alice['mapaddrs']) - 1, 1)
+    return [hashlib.sha256(unalice.pair_span(alice, k, k + step)).digest() for k in range(0, npairs, step)]
+
+def block_diff(a, b, translate=True):
+    # Compare runs of block pairs by the hash of their compressed bytes and
+    # decode only those that differ. Raises ValueError if a mapping table
+    # does not match the stream.
+    blocksize = a['blocksize']
+    step = unalice.pair_step(blocksize) # keep BL/BLX pairs within a run
+    runsize = step*2*blocksize
+    hashes_a = run_hashes(a, step)
+    hashes_b = run_hashes(b, step)
+
+    ranges = []
+    decoded = 0
+    for c in range(max(len(hashes_a), len(hashes_b))):
+        if c < len(hashes_a) and c < len(hashes_b) and hashes_a[c] == hashes_b[c]:
+            continue
+        k0 = c*step
+        buff_a = unalice.decode_pairs(a, k0, k0 + step, translate) if c < len(hashes_a) else bytearray()
+        buff_b = unalice.decode_pairs(b, k0, k0 + step, translate) if c < len(hashes_b) else bytearray()
+        decoded += 1
+        for start, end in changed_ranges(buff_a, buff_b, c*runsize, blocksize):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+    return {'runs': max(len(hashes_a), len(hashes_b)), 'runs_decoded': decoded, 'ranges': ranges}
+
+def full_diff(header_a, header_b, translate=True, jobs=1):
+    # Decode both images, each in jobs processes, and compare them
+    image_a = unalice.AliceDecoder(header_a, translate, jobs).decode()['image']
+    image_b = unalice.AliceDecoder(header_b, translate, jobs).decode()['image']
+    return {'size_a': len(image_a), 'size_b': len(image_b), 'ranges': changed_ranges(image_a, image_b)}
+
+def diff(header_a, header_b, translate=True, jobs=1, full=False):
+    # Returns a dict: mode (blocks or full), the changed ranges and, for
+    # the block mode, how many runs of block pairs were compared and decoded
+    a = header_a.fields
+    b = header_b.fields
+    if not full and same_tables(a, b):
+        try:
+            result = block_diff(a, b, translate)
+            result['mode'] = 'blocks'
+            return result
+        except ValueError as e:
+            print("--- %s, decoding in full"%(e))
+    elif not full:
+        print("--- range registers, blocksize or dictionary differ, decoding in full")
+    result = full_diff(header_a, header_b, translate, jobs)
+    result['mode'] = 'full'
+    return result
+
+def usage():
+    print("usage: alicediff.py [-t] [-j N] [--full] [--json file] <ALICE_A> <ALICE_B>")
+    print("       -t disable bl/blx addr translation")
+    print("       -j, --jobs N decode in N processes when decoding in full (default %d)"%(os.cpu_count() or 1))
+    print("       --full decode both images in full even if their dictionaries match")
+    print("       --json file write the changed ranges as JSON (- for stdout)")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "tj:", ["jobs=", "full", "json="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    if len(args) != 2:
+        usage()
+        sys.exit(1)
+
+    translate = True
+    jobs = os.cpu_count() or 1
+    full = False
+    jsonfile = None
+    for o, a in opts:
+        if o == "-t":
+            translate = False
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "--full":
+            full = True
+        elif o == "--json":
+            jsonfile = a
+
+    if jsonfile == "-":
+        # The report goes to stdout, everything else to stderr
+        out = sys.stdout
+        sys.stdout = sys.stderr
+
+    try:
+        header_a = alicebatch.open_image(args[0])
+        header_b = alicebatch.open_image(args[1])
+    except ValueError as e:
+        print("%s, quitting."%(e))
+        sys.exit(1)
+
+    t = time.perf_counter()
+    result = diff(header_a, header_b, translate, jobs, full)
+    seconds = time.perf_counter() - t
+
+    ranges = result['ranges']
+    for start, end in ranges:
+        print("0x%08x-0x%08x %d bytes"%(start, end, end - start))
+    if result['mode'] == 'blocks':
+        print("compared %d runs of block pairs, decoded %d"%(result['runs'], result['runs_decoded']))
+    print("%d changed ranges, %d bytes, in %.3f s"%(len(ranges), sum([end - start for start, end in ranges]), seconds))
+
+    if jsonfile is not None:
+        result.update({
+            'a': args[0],
+            'b': args[1],
+            'translate': translate,
+            'seconds': round(seconds, 3),
+            'ranges': [{'start': start, 'end': end} for start, end in ranges],
+        })
+        f = out if jsonfile == "-" else open(jsonfile, "w")
+        json.dump(result, f, indent=2)
+        f.write("\n")
+        if jsonfile != "-":
+            f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+'''
+Firmware scanner
+
+Find the known partitions in a full Mediatek firmware dump and report their
+offsets and sizes as JSON, optionally extracting them to files.
+
+The dump is memory mapped and searched for all signatures in a single pass:
+
+    GFH FILE_INFO   "MMM" file header in front of the bootloaders and the
+                    kernel (ROM), gives the file type and length
+    VIVA            user partition header
+    ZIMAGE          LZMA compressed resources (ZIMAGE_ER)
+    BOOT_ZIMAGE     usually empty
+    DCMCMP          LZMA compressed parts
+    ALICE_1/ALICE_2 main firmware, see unalice.py
+
+Sizes come from the partition header where the format is known (GFH, ALICE),
+otherwise a partition runs up to the next signature. ZIMAGE, BOOT_ZIMAGE,
+DCMCMP and ALICE are part of the user partition, so they do not end the VIVA
+partition.
+
+Extracted partitions are written with one large copy each. Library users can
+skip extraction altogether and hand the mapped dump to unalice.parse_alice()
+with the offset of an ALICE partition.
+
+Requirements:
+    python3
+
+Copyright 2018 Donn Morrison donn.morrison@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import sys
+import mmap
+import json
+import struct
+import getopt
+
+import unalice
+
+# Order matters, BOOT_ZIMAGE must be tried before ZIMAGE
+SIGNATURES = [
+    ('GFH', rb'MMM\x01\x38\x00\x00\x00FILE_INFO\x00'),
+    ('VIVA', rb'VIVA'),
+    ('BOOT_ZIMAGE', rb'BOOT_ZIMAGE'),
+    ('ZIMAGE', rb'ZIMAGE'),
+    ('DCMCMP', rb'DCMCMP'),
+    ('ALICE', rb'ALICE_[12]\x00'),
+]
+
+SIGNATURE_RE = re.compile(b'|'.join(b'(?P<%s>%s)'%(name.encode(), pattern) for name, pattern in SIGNATURES))
+
+# GFH file types
+GFH_TYPES = {
+    0x0001: 'BOOTLOADER',
+    0x0002: 'EXT_BOOTLOADER',
+}
+
+# Partitions inside the VIVA user partition
+VIVA_PARTS = ('ZIMAGE', 'BOOT_ZIMAGE', 'DCMCMP', 'ALICE_1', 'ALICE_2')
+
+def parse_gfh(data, offset):
+    file_type, = struct.unpack_from("<H", data, offset + 24)
+    load_addr, file_len = struct.unpack_from("<LL", data, offset + 28)
+    if file_type in GFH_TYPES:
+        name = GFH_TYPES[file_type]
+    elif file_type & 0xff00 == 0x0100: # MAUI binaries
+        name = 'ROM'
+    else:
+        name = 'GFH_%04x'%(file_type)
+    part = {'name': name, 'offset': offset, 'file_type': file_type, 'load_addr': load_addr}
+    if 0 < file_len <= len(data) - offset:
+        part['size'] = file_len
+    return part
+
+def parse_alice(data, offset):
+    try:
+        alice = unalice.parse_alice(data, offset)
+    except (ValueError, struct.error):
+        return None # just the string, not a header
+    # The dictionary runs to the end of the partition, which the header does
+    # not tell us. Entries are distinct instructions, so stop at the first
+    # repeat (e.g. 0xffff padding).
+    seen = set()
+    for instr in alice['instrdict']:
+        if instr in seen:
+            break
+        seen.add(instr)
+    size = alice['dict_offset'] + 2*len(seen)
+    return {'name': alice['magic'].decode(), 'offset': offset, 'size': size,
+        'base': alice['base'], 'blocksize': alice['blocksize'], 'range_regs': alice['range_regs']}
+
+def scan(data):
+    # Returns the partitions found in data, sorted by offset
+    parts = []
+    for m in SIGNATURE_RE.finditer(data):
+        name = m.lastgroup
+        offset = m.start()
+        if name == 'GFH':
+            part = parse_gfh(data, offset)
+        elif name == 'ALICE':
+            part = parse_alice(data, offset)
+        else:
+            part = {'name': name, 'offset': offset}
+        if part is not None:
+            parts.append(part)
+
+    # Drop bare tags found inside a partition of known size, e.g. strings in
+    # the kernel or chance matches in compressed data. Headers that parsed
+    # are always kept.
+    sized = [p for p in parts if 'size' in p]
+    parts = [p for p in parts if 'size' in p or
+        not any(k['offset'] < p['offset'] < k['offset'] + k['size'] for k in sized)]
+
+    # Everything else runs up to the next signature it does not contain
+    for i, part in enumerate(parts):
+        if part['name'] == 'VIVA':
+            following = [p for p in parts[i+1:] if p['name'] not in VIVA_PARTS]
+        else:
+            following = parts[i+1:]
+        end = following[0]['offset'] if following else len(data)
+        if 'size' in part:
+            part['size'] = min(part['size'], end - part['offset'])
+        else:
+            part['size'] = end - part['offset']
+    return parts
+
+def extract(data, parts, outdir):
+    view = memoryview(data)
+    for part in parts:
+        filename = os.path.join(outdir, "%08x_%s.bin"%(part['offset'], part['name'].lower()))
+        f = open(filename, "wb")
+        f.write(view[part['offset']:part['offset'] + part['size']])
+        f.close()
+        part['file'] = filename
+
+def usage():
+    print("usage: fwscan.py [-x outdir] <firmware>")
+    print("       -x extract partitions to outdir")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "x:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+
+    outdir = None
+    for o, a in opts:
+        if o == "-x":
+            outdir = a
+
+    f = open(args[0], "rb")
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+
+    parts = scan(data)
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+        extract(data, parts, outdir)
+
+    print(json.dumps(parts, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -16,15 +16,32 @@ remaining bits in the current byte and move to the next start-of-byte.
 As each range encoded instruction is unpacked, we look it up in the dictionary
 appended to the end of ALICE to reveal the original instruction.
 
+The compressed region is read as plain integers through a small bit window
+rather than a bit string. A table built once from the range registers gives
+the length and dictionary offset of each 3-bit prefix.
+
+Decoding stops at the end of the compressed data, taken from the last mapping
+table entry (or the start of the mapping table). alice.py records the zero
+bits padding the final block in the length bits of that entry, so its images
+stop exactly. ALICE.exe leaves them zero: every block the table lists is
+decoded and only the padding of the final block (fewer than 8 zero bits) is
+left out. Zero bits that can be either padding or the all-zero code of the
+first dictionary entry (7 bits or shorter) are taken as padding unless a
+single zero byte follows the data (ALICE.exe's tail byte) or they complete
+the final block. ALICE.exe pads the mapping table to 4 bytes, which hides
+that byte, so a short final block ending on a byte boundary with such a code
+loses its last instruction.
+
+The module can be imported: AliceHeader and AliceDecoder decode components
+held in any buffer, AliceImage reads parts of one without decoding it all.
+Given a Stats object they record the time spent in each stage and count the
+symbols of each prefix (--stats writes these as JSON).
+
 Requirements:
-    python
-    bitstring for python https://github.com/scott-griffiths/bitstring
+    python3
 
 Copyright 2018 Donn Morrison donn.morrison@gmail.com
 
-TODO:
-    - find correct EOF and stop decoding
-
 This program is free software: you can redistribute it and/or modify
 it under the terms of the GNU General Public License as published by
 the Free Software Foundation, either version 3 of the License, or
@@ -39,290 +56,1144 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import math
 import os
+import re
 import sys
+import json
+import math
+import mmap
+import shutil
+import hashlib
 import struct
 import getopt
-from bitstring import BitArray
+import contextlib
+import time
+import collections
+import multiprocessing
+from array import array
 
-def bitunpack():
-    global fout, instrdict, range_regs, bitbuff, mappings, alicebin, blocksize
-    bitptr = 0
-    numblocks = 0
+def symbol_table(range_regs):
+    # One entry per 3-bit prefix 000, 001, ..., 111:
+    #  (range encoded instruction length incl. prefix, index mask,
+    #   dictionary offset of the range)
+    # The dictionary offset is the sum of the sizes of all previous ranges.
+    table = []
+    low = 0
+    for r in range_regs:
+        table.append((r + 3, (1 << r) - 1, low))
+        low += 1 << r
+    return table
+
+def end_of_data(data, endptr):
+    # endptr is the end of the compressed data (from the mapping table, or
+    # the end of the compressed region), a byte boundary. Only the final
+    # block is padded, with fewer than 8 zero bits up to that byte. Returns
+    # the bit position no symbol starts at or after: past the last 1 bit
+    # of the final byte, at most 7 bits back. Every block the mapping table
+    # lists is decoded, even if all of it is zero bits (the first
+    # dictionary entry, all-zero code).
+    if endptr == 0:
+        return 0
+    last = data[(endptr >> 3) - 1]
+    zeros = (last & -last).bit_length() - 1 if last else 8
+    return endptr - min(zeros, 7)
+
+class Stats:
+    '''
+    Opt-in instrumentation of a decode (or encode, see alice.py).
+
+    stage(name) is a context manager adding the wall time of its body to
+    stages[name] (add(name, seconds) for times measured elsewhere, e.g. in
+    worker processes), count(name, n) adds to counters[name] and symbols holds
+    the number of symbols decoded for each 3-bit prefix, prefix 7 being
+    unencoded (escaped) instructions. hook, if given, is called with
+    (name, seconds) as each stage ends, e.g. to feed a profiler or
+    monitoring. as_dict() is ready for json.dump().
+    '''
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.stages = {}
+        self.counters = {}
+        self.symbols = [0]*8
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self.hook is not None:
+            self.hook(name, seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        total = sum(self.symbols)
+        return {
+            'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+            'counters': dict(self.counters),
+            'symbols': list(self.symbols),
+            'escapes': self.symbols[7],
+            'escape_fraction': round(self.symbols[7]/total, 6) if total else 0.0,
+        }
+
+def stage(stats, name):
+    # stats.stage(name), or nothing when not instrumented
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
+
+def bitunpack(buff, mapaddrs, maplens, instrdict, range_regs, blocksize, offset=0, numblocks=0, stopblock=None, boundaries=None, symbols=None):
+    # buff holds the compressed region from byte address offset onwards,
+    # which must be the start of block numblocks. Decoding stops at the end
+    # of the compressed data or when block stopblock is reached. Returns
+    # the decoded instructions and the bit pointer where decoding stopped.
+    # The start address of every decoded block is appended to boundaries,
+    # for verify_blocks(). symbols, a list of 8 counts, counts the symbols
+    # decoded for each prefix.
     byteswritten = 0
-    lastblockbitptr = 0
-    matchedblocks = 0
-    lastblock = False
-    lastinstr = None
-
-    # Range register dependent vectors:
-    #  starts 000, 001, ..., 111
-    #  prefixes are starts shifted by respective range reg
-    #  lengths are range encoded instruction lengths + starts
-    #  range_regs_pow dictionary boundaries (ranges)
-    starts = range(0,8) # each 3 bits long
-    prefixes = [start << r for start,r in zip(starts, range_regs)]
-    lengths = [r + 3 for r in range_regs]
-    range_regs_pow = [0] + [int(math.pow(2, r)) for r in range_regs[0:-1]]
-
-    while bitptr < ((mappings[-1])[0] + mappings[-1][1])*8 and bitptr < len(bitbuff): # mapping table addr + len
+
+    table = symbol_table(range_regs)
+    out = array('H')
+
+    # Read the compressed region as plain integers, 32 bits at a time from
+    # the byte holding bitptr. The longest symbol (19 bits) plus the bit
+    # offset into the first byte always fits in the window. Zero tail so the
+    # window never runs off the end.
+    nbits = len(buff)*8
+    data = bytes(buff) + bytes(12)
+    bitptr = 0
+    dataend = min((mapaddrs[-1] - offset)*8, nbits) # last mapping table entry
+    padded = 0 < maplens[-1] <= 8 and dataend == (mapaddrs[-1] - offset)*8
+    endptr = dataend
+    if stopblock is None and padded:
+        # Runs to the end of the stream, padding recorded by alice.py
+        endptr = dataend - (maplens[-1] - 1)
+    elif stopblock is None:
+        # Runs to the end of the stream
+        endptr = end_of_data(data, dataend)
+
+    while bitptr < endptr:
         # Check if we've done a block
         if blocksize != 0 and (byteswritten % blocksize) == 0:
-#            print("--- hit a block at %d bytes written, compressed index 0x%08x, rem %d, %d"%(byteswritten, int(bitptr/8),bitptr%8, bitptr))
-            sys.stdout.flush()
             # FFW to the next byte offset
-            if bitptr%8 != 0:
-                bitptr = bitptr + (8 - (bitptr%8))
-
-            # Check every even block against mapping table
-            if numblocks%2 == 0:
-#                print("--- corresponding maptable addr 0x%08x len %d"%(mappings[int(numblocks/2)][0], mappings[int(numblocks/2)][1]))
-                if int(bitptr/8) in [m for m,l in mappings]:
-                    matchedblocks += 1
-#                    print("   --- bitptr in mapping table! matchedblocks = %d"%(matchedblocks))
-#                else:
-#                    print("   --- bitptr 0x%08x NOT in mapping table!"%(int(bitptr/8)))
-#            print("--- ptr forwarded to next byte %d, numblocks = %d"%(bitptr, numblocks))
-#            print("--- distance to start of previous block %d bits (%d bytes)"%(bitptr-lastblockbitptr,int((bitptr-lastblockbitptr)/8)))
-            lastblockbitptr = bitptr
+            bitptr = (bitptr + 7) & ~7
+            if numblocks == stopblock or bitptr >= endptr:
+                break
+
+            if boundaries is not None:
+                boundaries.append(offset + (bitptr >> 3))
             numblocks += 1
-            #if math.ceil(numblocks/2) == len(mappings) -1:
-#            print("--- at pos %02f"%((numblocks/2) / float(len(mappings)-1)))
-
-            # FIXME EOF detection is a hack based on observations.
-            # We first check if we're near the end of the compressed region,
-            # then lookahead for low 1 counts in the bit buffer, or observed
-            # EOF instruction sequence (0xeaff, 0x0000)
-            if (numblocks/2) / float(len(mappings)-1) > 0.999: # Somewhere near the end?
-                # We've reached possibly the last complete block
-                print("--- Possible last block, now scanning for EOF signature instructions")
-                lastblock = True
-#        print("next 64 bits: %s"%(format(bitbuff[bitptr:bitptr+64].uint, '#066b')))
-#        print("contains %d ones"%(bin(bitbuff[bitptr:bitptr+64].uint)[2:].count('1')))
 
+        off = bitptr & 7
+        window = int.from_bytes(data[bitptr >> 3:(bitptr >> 3) + 4], 'big')
         # Look for instruction header
-        for s,l in zip(starts,lengths):
-            if bitbuff[bitptr:bitptr+3].uint == s:
-                # Fetch the range encoded instruction
-                instr = bitbuff[bitptr:bitptr+l].uint
-#                print("%d (0x%x,%d): fetched instruction 0x%08x and prefix 0x%x, length %d"%(bitptr, int(bitptr/8), bitptr%8, instr, prefixes[starts.index(s)], l))
-
-                # FIXME EOF detection is a hack based on observations.
-                # We first check if we're near the end of the compressed region,
-                # then lookahead for low 1 counts in the bit buffer, or observed
-                # EOF instruction sequence (0xeaff, 0x0000)
-                if (lastblock and bin(bitbuff[bitptr:bitptr+64].uint)[2:].count('1') < 2):
-                    print("--- Last block, mostly zero bits left (< 2 of 64). Stopping.")
-                    return
-                if (lastblock and instr == 1 and s == 0 and lastinstr == 0xeaff): # If we're left with mostly zeros, probably at end
-                    print("--- Last block, end instructions detected (0xeaff, 0x0000). Stopping.")
-                    return
-                # If encoded, look up in dictionary
-                if s != 0x7:
-                    # Find the range (have to sum previous ranges to get correct index)
-                    low = sum(range_regs_pow[0:starts.index(s)+1])
-                    # Subtract the instruction prefix
-                    instridx = instr - prefixes[starts.index(s)]
-                    # This is the index into the range_reg subrange
-                    originstr = instrdict[low + instridx]
-                else:
-                    # Not encoded, simply extract the instruction
-                    originstr = instr & 0xffff
-#                print("original instruction 0x%04x written at 0x%08x"%(originstr,byteswritten))
-                lastinstr = originstr
-                decomp = struct.pack("<H", originstr)
-                # Write decoded instruction to buffer/file
-                fout.write(decomp)
-                byteswritten += len(decomp)
-                alicebin += bytearray(decomp)
-                # Advance pointer
-                bitptr += l
-                break
-    return
+        s = (window >> (29 - off)) & 7
+        l, mask, low = table[s]
+        if symbols is not None:
+            symbols[s] += 1
+        # Fetch the range encoded instruction, without its prefix
+        instridx = (window >> (32 - off - l)) & mask
+
+        # If encoded, look up in dictionary
+        if s != 0x7:
+            out.append(instrdict[low + instridx])
+        else:
+            # Not encoded, simply extract the instruction
+            out.append(instridx & 0xffff)
+        byteswritten += 2
+        # Advance pointer
+        bitptr += l
+
+    if stopblock is None and not padded and blocksize != 0 and byteswritten % blocksize:
+        # No padding recorded: whether the zero bits left after the last
+        # symbol (fewer than 8, see end_of_data()) are padding or all-zero
+        # symbols. They are symbols if they fill the final block. Otherwise
+        # ALICE.exe adds a zero byte after the data if the final block ends
+        # on a byte boundary (see tail_byte() in alice.py), so with a single
+        # zero byte there there is no padding. With no byte, some other
+        # byte or a longer gap at least one bit is taken as padding.
+        missing = (blocksize - byteswritten % blocksize) >> 1
+        l, mask, low = table[0]
+        zeros = dataend - bitptr
+        if 0 <= zeros - missing*l < 8:
+            fill = missing
+        elif nbits - dataend == 8 and data[dataend >> 3] == 0:
+            fill = min(max(zeros, 0) // l, missing)
+        else:
+            fill = min(max(zeros - 1, 0) // l, missing)
+        out.extend([instrdict[low]]*fill)
+        if symbols is not None:
+            symbols[0] += fill
+        bitptr += fill*l
+
+    if sys.byteorder == 'big':
+        out.byteswap()
+    return bytearray(out.tobytes()), bitptr
+
+# Expected start of a block the mapping table gives no length for
+NOBLOCK = 0xffffffff
+
+def block_index(mapaddrs, maplens):
+    # Expected start address of every block, built once from the mapping
+    # table. Even blocks start at their pair's entry (pair 0 at 0), odd
+    # blocks the length of the even block later. A final pair whose even
+    # block runs to the end entry has no odd block.
+    starts = array('I')
+    npairs = len(mapaddrs) - 1
+    for k in range(npairs):
+        start = mapaddrs[k] if k > 0 else 0
+        starts.append(start)
+        odd = start + maplens[k] if maplens[k] else NOBLOCK
+        if k == npairs - 1 and odd == mapaddrs[npairs]:
+            odd = NOBLOCK
+        starts.append(odd)
+    return starts
+
+def verify_blocks(blockstarts, boundaries, first=0):
+    # Compare decoded block start addresses (from bitunpack(), starting at
+    # block first and running to the end of the stream) against the block
+    # index. Returns a list of (block, decoded address, expected address)
+    # that do not match, the expected address is None past the end of the
+    # mapping table and the decoded address None for blocks the table
+    # lists that were never decoded.
+    mismatches = []
+    for b, addr in enumerate(boundaries, first):
+        if b >= len(blockstarts):
+            mismatches.append((b, addr, None))
+        elif blockstarts[b] != NOBLOCK and blockstarts[b] != addr:
+            mismatches.append((b, addr, blockstarts[b]))
+    for b in range(first + len(boundaries), len(blockstarts)):
+        if blockstarts[b] != NOBLOCK:
+            mismatches.append((b, None, blockstarts[b]))
+    return mismatches
+
+# BL/BLX pairs, matched on the high byte of each instruction: 0xf000 then
+# 0xf800 (BL) or 0xe800 (BLX)
+BL_BLX_RE = re.compile(rb'(?=[\xf0-\xf7][\xe8-\xef\xf8-\xff])')
 
-def untranslate_bl_blx():
-    global buff
-    ptr = 0 # ptr can be equiv to PC
+def bl_blx_pairs(buff, base=0):
+    # Instruction index of every BL/BLX pair in buff that ALICE translates,
+    # base is the instruction index of buff[0]. All pairs are found in one
+    # pass over the high bytes. A matching pair can never overlap another
+    # one (its second instruction is not 0xf000), so this is the same as
+    # walking the buffer one instruction at a time. A pair starting at
+    # every 32nd instruction is left alone.
+    for m in BL_BLX_RE.finditer(buff[1::2]):
+        ptr = m.start() # ptr can be equiv to PC
+        if (base+ptr+1) % 32 != 0:
+            yield ptr
+
+def untranslate_bl_blx(buff, base=0):
+    # base is the instruction index of buff[0] in the decompressed image
     bl_count = 0
     blx_count = 0
-    while ptr < len(buff)/2-1:
-        if (ptr+1) % 32 == 0:
-            ptr += 1
+    for ptr in bl_blx_pairs(buff, base):
+        instr, instr2 = struct.unpack_from("<HH", buff, ptr*2)
+        if (instr2 & 0xf800) == 0xf800: # bit 12 = 1, BL instruction
+            upbits = 0xf800
+            bl_count += 1
+        else: # bit 12 = 0, BLX instruction
+            upbits = 0xe800
+            blx_count += 1
+
+        if instr & 0x400: # if J2 bit is set
+            # shift imm11 left 11 bits, add lower bits from imm10 + sign
+            # multiply by two, subtract 0x7ffffffe?
+            v10 = ((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff) - (base+ptr-1) + 0x7ffffffe
+        else:
+            # shift imm11 left 11 bits, add lower bits from imm10 + sign
+            # multiply by two, add 2
+            v10 = ((instr & 0x7ff) << 0x0b) + (instr2 & 0x7ff) - (base+ptr-1) - 0x00000002
+
+        # reassemble branch target
+        instr = (v10 >> 0x0b) & 0x7ff | 0xf000 # high bits
+        instr2 = v10 & 0x7ff | upbits   # low bits
+        struct.pack_into("<HH", buff, ptr*2, instr, instr2)
+
+    return bl_count, blx_count
+
+def pair_step(blocksize):
+    # Block pairs (blocksize instructions each) in the shortest run that
+    # ends at a multiple of 32 instructions. Runs of whole steps start where
+    # the translation skips a pair, so no BL/BLX pair straddles two runs.
+    return 32 // math.gcd(blocksize, 32)
+
+def plan_segments(mapaddrs, blocksize, jobs):
+    # Split the compressed stream into runs of block pairs at mapping table
+    # boundaries. A pair is two blocks, i.e. blocksize instructions. Segments
+    # must start at a multiple of 32 instructions so no BL/BLX pair can
+    # straddle two segments (the translation skips every 32nd instruction).
+    npairs = len(mapaddrs) - 1
+    step = pair_step(blocksize)
+    size = -(-npairs // (jobs*4)) # a few segments per job to balance load
+    size = max(step, -(-size // step) * step)
+    segments = []
+    for k in range(0, max(npairs, 1), size):
+        segments.append((k, k + size))
+    segments[-1] = (segments[-1][0], None) # last one runs to the end
+    return segments
+
+_segment_state = None
+
+def init_segment(source, offset, translate, header_size=None, blocksize=None, count_symbols=False):
+    # Each worker maps the file itself, pages are shared through the page
+    # cache. source can also be the component's bytes.
+    global _segment_state
+    if isinstance(source, str):
+        _segment_state = (read_alice(source, offset, header_size, blocksize), translate, count_symbols)
+    else:
+        _segment_state = (parse_alice(source, offset, header_size, blocksize), translate, count_symbols)
+
+def unpack_segment(segment):
+    alice, translate, count_symbols = _segment_state
+    k0, k1 = segment
+    mapaddrs = alice['mapaddrs']
+    buff = alice['buff']
+    blocksize = alice['blocksize']
+
+    start = mapaddrs[k0] if k0 > 0 else 0
+    if k1 is None:
+        data = buff[start:]
+        stopblock = None
+    else:
+        data = buff[start:mapaddrs[k1]]
+        stopblock = 2*k1
+    boundaries = array('I')
+    symbols = [0]*8 if count_symbols else None
+    t = time.perf_counter()
+    decoded, bitptr = bitunpack(data, mapaddrs, alice['maplens'], alice['instrdict'], alice['range_regs'], blocksize, start, 2*k0, stopblock, boundaries, symbols)
+    times = [time.perf_counter() - t, 0.0]
+
+    untranslated = None
+    counts = (0, 0)
+    if translate:
+        t = time.perf_counter()
+        untranslated = bytearray(decoded)
+        counts = untranslate_bl_blx(untranslated, k0*blocksize)
+        times[1] = time.perf_counter() - t
+    return decoded, untranslated, counts, start*8 + bitptr, boundaries, symbols, times
+
+def parallel_unpack(source, offset, alice, jobs, translate, stats=None):
+    # Decode segments across a process pool and stitch them in order, with
+    # the start address of every block. The workers' bitunpack and
+    # untranslate times (summed over segments) and symbol counts are added
+    # to stats.
+    # Returns None if the mapping table does not agree with the decoded
+    # block boundaries, in which case the caller should decode serially.
+    mapaddrs = alice['mapaddrs']
+    blocksize = alice['blocksize']
+    segments = plan_segments(mapaddrs, blocksize, jobs)
+
+    decoded = bytearray()
+    untranslated = bytearray()
+    boundaries = array('I')
+    bl_count = blx_count = 0
+    initargs = (source, offset, translate, alice['header_size'], blocksize, stats is not None)
+    with multiprocessing.Pool(jobs, init_segment, initargs) as pool:
+        for (k0, k1), (dec, untr, counts, bitptr, starts, segsymbols, times) in zip(segments, pool.imap(unpack_segment, segments)):
+            decoded += dec
+            boundaries += starts
+            if stats is not None:
+                for s in range(8):
+                    stats.symbols[s] += segsymbols[s]
+                stats.add('bitunpack', times[0])
+                if translate:
+                    stats.add('untranslate', times[1])
+            if translate:
+                untranslated += untr
+                bl_count += counts[0]
+                blx_count += counts[1]
+            if k1 is None:
+                break
+            if len(dec) < (k1 - k0)*2*blocksize:
+                # Ran out of data, a serial decode stops here too
+                break
+            if bitptr != mapaddrs[k1]*8:
+                print("--- segment %d-%d ends at 0x%08x, mapping table says 0x%08x"%(k0, k1, bitptr >> 3, mapaddrs[k1]))
+                pool.terminate()
+                return None
+
+    if not translate:
+        untranslated = decoded
+    return decoded, untranslated, bl_count, blx_count, boundaries
+
+def iter_image(alice, translate=True, pairs=512, boundaries=None, stats=None):
+    # Decode the whole image in order, a run of block pairs at a time, and
+    # yield the decompressed bytes (untranslated unless translate is off).
+    # Each run continues where the previous one stopped, as a serial decode
+    # would. Only one run of compressed and decoded data is held at a time.
+    buff = alice['buff']
+    blocksize = alice['blocksize']
+    step = pair_step(blocksize) # keep BL/BLX pairs within a run
+    pairs = max(step, pairs // step * step)
+    # Longest a run can be: every instruction escaped, every block padded
+    maxlen = (pairs*blocksize*19 >> 3) + 2*pairs
+    # End of the data, the last mapping table entry as in bitunpack()
+    dataend = min(alice['mapaddrs'][-1], len(buff))
+    start = 0
+    numblocks = 0
+    while True:
+        stopblock = numblocks + 2*pairs
+        if start + maxlen >= dataend:
+            stopblock = None # last run, decode to the end of the data
+        data = buff[start:start + maxlen]
+        with stage(stats, 'bitunpack'):
+            decoded, bitptr = bitunpack(data, alice['mapaddrs'], alice['maplens'], alice['instrdict'], alice['range_regs'], blocksize, start, numblocks, stopblock, boundaries,
+                stats.symbols if stats is not None else None)
+        if translate:
+            with stage(stats, 'untranslate'):
+                counts = untranslate_bl_blx(decoded, (numblocks >> 1)*blocksize)
+            if stats is not None:
+                stats.count('bl', 2*counts[0])
+                stats.count('blx', 2*counts[1])
+        if decoded:
+            yield decoded
+        if stopblock is None or len(decoded) < 2*pairs*blocksize:
+            return
+        start += bitptr >> 3
+        numblocks = stopblock
+
+def sample_pairs(npairs, samples):
+    # Block pairs spread evenly over the image, except the last one which
+    # may be short
+    n = min(samples, npairs - 1)
+    if n <= 0:
+        return []
+    return sorted(set(i*(npairs - 1)//n for i in range(n)))
+
+def decode_pair(alice, k):
+    # Decode block pair k alone, None if it does not end where the mapping
+    # table says the next pair starts
+    mapaddrs = alice['mapaddrs']
+    blocksize = alice['blocksize']
+    start = mapaddrs[k] if k > 0 else 0
+    end = mapaddrs[k+1]
+    if not start < end <= len(alice['buff']):
+        return None
+    decoded, bitptr = bitunpack(alice['buff'][start:end], mapaddrs, alice['maplens'], alice['instrdict'], alice['range_regs'], blocksize, start, 2*k, 2*k+2)
+    if len(decoded) != 2*blocksize or start*8 + bitptr != end*8:
+        return None
+    return decoded
+
+def bl_targets(buff, base, translated):
+    # Instruction index of the target of every BL/BLX pair in buff, base is
+    # the instruction index of buff[0]. translated: the pairs hold absolute
+    # targets as ALICE.exe stores them, otherwise plain Thumb offsets.
+    targets = []
+    for ptr in bl_blx_pairs(buff, base):
+        instr, instr2 = struct.unpack_from("<HH", buff, ptr*2)
+        field = ((instr & 0x7ff) << 11) | (instr2 & 0x7ff)
+        if translated:
+            targets.append((base + ptr, field + 1))
+        else:
+            if field & 0x200000:
+                field -= 0x400000
+            targets.append((base + ptr, base + ptr + 2 + field))
+    return targets
+
+def score_targets(targets, ninstrs):
+    # Fraction of targets inside the image, and the median call distance
+    if not targets:
+        return 0.0, 0
+    inside = len([1 for ptr, target in targets if 0 <= target < ninstrs])
+    # BL reaches +-4 MB, distances wrap around like the offsets do
+    distances = sorted(abs(((target - ptr + 0x200000) & 0x3fffff) - 0x200000) for ptr, target in targets)
+    return inside / len(targets), distances[len(distances)//2]
+
+def detect(data, offset=0, samples=64):
+    # Pick the header layout and the BL/BLX translation mode from a sample
+    # of block pairs, decoded through the mapping table.
+    # The layout (header size, blocksize) is the one for which most sampled
+    # pairs end exactly at the next mapping entry; the header's own layout
+    # wins ties. Only ALICE_1 has alternatives. The translation mode is the
+    # one that puts more BL/BLX targets inside the image, or, if both do
+    # about as well (images near the 4 MB BL range), that gives the shorter
+    # median call distance. Decoding the wrong way round scatters targets
+    # over the whole image. Without a clear majority of targets inside the
+    # image in either mode, translation stays on (the default).
+    default = parse_alice(data, offset)
+    candidates = [(default['header_size'], default['blocksize'])]
+    if default['version'] == 1:
+        view = memoryview(data)[offset:]
+        blocksizes = [64, 32, 128]
+        hdrblocksize = struct.unpack_from("<H", view, 36)[0]
+        if hdrblocksize in (16, 32, 64, 128, 256, 512):
+            blocksizes.insert(0, hdrblocksize)
+        for header_size in (40, 36):
+            for blocksize in blocksizes:
+                if (header_size, blocksize) not in candidates:
+                    candidates.append((header_size, blocksize))
+
+    best = None
+    for header_size, blocksize in candidates:
+        try:
+            alice = parse_alice(data, offset, header_size, blocksize)
+        except (ValueError, struct.error):
             continue
+        pairs = sample_pairs(len(alice['mapaddrs']) - 1, samples)
+        decoded = [(k, decode_pair(alice, k)) for k in pairs]
+        decoded = [(k, buff) for k, buff in decoded if buff is not None]
+        score = len(decoded) / len(pairs) if pairs else 0.0
+        if best is None or score > best[0]:
+            best = (score, alice, decoded)
+    score, alice, decoded = best
+
+    ninstrs = (len(alice['mapaddrs']) - 1)*alice['blocksize']
+    translated = []
+    plain = []
+    for k, buff in decoded:
+        translated += bl_targets(buff, k*alice['blocksize'], True)
+        plain += bl_targets(buff, k*alice['blocksize'], False)
+    inside, distance = score_targets(translated, ninstrs)
+    plain_inside, plain_distance = score_targets(plain, ninstrs)
+    if max(inside, plain_inside) < 0.5:
+        translate = True
+    elif abs(inside - plain_inside) > 0.1:
+        translate = inside > plain_inside
+    else:
+        translate = distance <= plain_distance
+
+    return {
+        'header_size': alice['header_size'],
+        'blocksize': alice['blocksize'],
+        'layout_score': score,
+        'layouts': len(candidates),
+        'translate': translate,
+        'branches': len(translated),
+        'translated_score': (inside, distance),
+        'plain_score': (plain_inside, plain_distance),
+    }
+
+def le_array(typecode, data):
+    # Bulk parse little endian words into a compact array
+    arr = array(typecode)
+    arr.frombytes(data[:len(data) - len(data) % arr.itemsize])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def parse_alice(data, offset=0, header_size=None, blocksize=None, stats=None):
+    # data is any buffer (bytes, mmap, memoryview) holding an ALICE component
+    # at offset, e.g. a full firmware dump. Nothing is copied except the
+    # mapping table and dictionary, which are parsed into arrays.
+    # header_size and blocksize override what the header says, see detect().
+    # stats times the header, mapping table and dictionary separately.
+    with stage(stats, 'header parse'):
+        view = memoryview(data)[offset:]
+        magic = bytes(view[0:7])
+        if magic == b'ALICE_1':
+            alice_version = 1
+        elif magic == b'ALICE_2':
+            alice_version = 2
+        else:
+            raise ValueError("found %s, expected ALICE_2"%(magic))
+
+        if header_size is None:
+            header_size = 40 # ALICE_2 or ALICE_1 with full header
+            if alice_version == 1:
+                endbytes = bytes(view[36:40]) # Check ALICE_1
+                if endbytes != b'\x00\x00\xff\xff':
+                    header_size = 36 # ALICE_1 with short header
+
+        base, mapping_offset, dict_offset = struct.unpack_from("<LLL", view, 8)
+        mapping_offset -= base - header_size
+        dict_offset -= base - header_size
+        compressed_offset = header_size
+
+        # Range registers
+        range_regs = list(struct.unpack_from("<7H", view, 20))
+        range_regs.append(16) # for infrequent instructions (0x70000 | instr) length 16+3=19
 
-        instr = buff[ptr*2] | (buff[ptr*2+1] << 8)
-        instr2 = buff[ptr*2+2] | (buff[ptr*2+3] << 8)
-
-        if (instr & 0xf800) == 0xf000:
-            if (instr2 & 0xf800) == 0xf800: # bit 12 = 1, BL instruction
-                upbits = 0xf800
-                bl_count += 1
-            elif (instr2 & 0xf800) == 0xe800: # bit 12 = 0, BLX instruction
-                upbits = 0xe800
-                blx_count += 1
-            else:
-                ptr += 1
+        if blocksize is None:
+            blocksize = 0
+            if header_size == 40:
+                blocksize = struct.unpack_from("<H", view, 36)[0]
+            if blocksize == 0:
+                blocksize = 64 # FIXME correct default for ALICE_1? see detect()
+
+        if not compressed_offset <= mapping_offset <= dict_offset <= len(view):
+            raise ValueError("bad mapping/dictionary offsets 0x%08x 0x%08x"%(mapping_offset, dict_offset))
+
+        # The dictionary runs to the end of the component. Entries past the sum
+        # of the range sizes can never be referenced, so stop there in case the
+        # component is followed by other data (full firmware dump).
+        dictmax = sum(1 << r for r in range_regs[0:-1])
+        filesize = min(len(view), dict_offset + 2*dictmax)
+
+        buff = view[compressed_offset:mapping_offset]
+
+    with stage(stats, 'mapping load'):
+        rawmappings = le_array('I', view[mapping_offset:dict_offset])
+        mapaddrs = array('I', [(mapping - base) & 0x00ffffff for mapping in rawmappings])
+        extra = (3*int(blocksize/2) >> 3) + 1
+        maplens = array('H', [((mapping >> 26) + extra) if mapping & 0xff000000 else 0 for mapping in rawmappings]) # FIXME hardcoded 26
+        if rawmappings:
+            # The end entry has no block, alice.py puts the zero bits
+            # padding the final block there, plus one (zero if unknown)
+            maplens[-1] = rawmappings[-1] >> 26
+
+        blockstarts = block_index(mapaddrs, maplens)
+
+    with stage(stats, 'dictionary load'):
+        instrdict = le_array('H', view[dict_offset:filesize])
+
+    return {
+        'magic': magic,
+        'version': alice_version,
+        'offset': offset,
+        'filesize': filesize,
+        'base': base,
+        'header_size': header_size,
+        'blocksize': blocksize,
+        'compressed_offset': compressed_offset,
+        'mapping_offset': mapping_offset,
+        'dict_offset': dict_offset,
+        'range_regs': range_regs,
+        'buff': buff,
+        'rawmappings': rawmappings,
+        'mapaddrs': mapaddrs,
+        'maplens': maplens,
+        'blockstarts': blockstarts,
+        'instrdict': instrdict,
+    }
+
+def map_file(alicefile):
+    f = open(alicefile, "rb")
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        f.close()
+        raise ValueError("%s is empty"%(alicefile))
+    f.close()
+    return data
+
+def read_alice(alicefile, offset=0, header_size=None, blocksize=None, stats=None):
+    # Map the file instead of reading it, the compressed region is handed
+    # out as a memoryview into the mapping
+    return parse_alice(map_file(alicefile), offset, header_size, blocksize, stats)
+
+class AliceHeader:
+    '''
+    Header, mapping table and dictionary of one ALICE component.
+
+    Every field parsed by parse_alice() is an attribute (magic, version,
+    base, blocksize, range_regs, buff, mapaddrs, maplens, blockstarts,
+    instrdict, ...), the dict itself is in fields. data is any buffer, only
+    the tables are copied. Raises ValueError if there is no valid header at
+    offset. Parsing is timed into stats, if given.
+    '''
+
+    def __init__(self, data, offset=0, source=None, header_size=None, blocksize=None, stats=None):
+        self.data = data
+        self.fields = parse_alice(data, offset, header_size, blocksize, stats)
+        for key, value in self.fields.items():
+            setattr(self, key, value)
+        # Where worker processes find the component again, see AliceDecoder
+        self.source = source if source is not None else data
+
+    @classmethod
+    def from_file(cls, alicefile, offset=0, header_size=None, blocksize=None, stats=None):
+        return cls(map_file(alicefile), offset, alicefile, header_size, blocksize, stats)
+
+# Part of every cache key, bump whenever the decoded output changes
+DECODER_VERSION = 3
+
+class DecodeCache:
+    '''
+    On-disk cache of decoded images, keyed by the contents of the ALICE
+    component (header, compressed region, mapping table and dictionary),
+    DECODER_VERSION, the translation setting and the header layout.
+
+    Each entry is a directory under directory holding the files unalice.py
+    writes plus the block boundaries and counts. Entries are written to a
+    temporary directory and renamed into place, so several processes can
+    share a cache. When the cache grows past max_bytes, the least recently
+    used entries are removed.
+    '''
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, header, translate):
+        h = hashlib.sha256()
+        h.update(b"unalice %d %d %d %d\n"%(DECODER_VERSION, bool(translate), header.header_size, header.blocksize))
+        h.update(memoryview(header.data)[header.offset:header.offset + header.filesize])
+        return h.hexdigest()
+
+    def get(self, key):
+        entry = os.path.join(self.directory, key)
+        try:
+            f = open(os.path.join(entry, "meta.json"), "r")
+            result = json.load(f)
+            f.close()
+            f = open(os.path.join(entry, "alice-translated-py.bin"), "rb")
+            result['decoded'] = f.read()
+            f.close()
+            result['image'] = result['decoded']
+            if os.path.exists(os.path.join(entry, "alice-py.bin")):
+                f = open(os.path.join(entry, "alice-py.bin"), "rb")
+                result['image'] = f.read()
+                f.close()
+            f = open(os.path.join(entry, "blocks.bin"), "rb")
+            result['boundaries'] = le_array('I', f.read())
+            f.close()
+            os.utime(entry) # most recently used
+        except (OSError, ValueError):
+            return None # missing, or evicted while reading
+        return result
+
+    def put(self, key, result):
+        entry = os.path.join(self.directory, key)
+        tmp = os.path.join(self.directory, ".%s.%d"%(key, os.getpid()))
+        os.makedirs(tmp, exist_ok=True)
+        f = open(os.path.join(tmp, "alice-translated-py.bin"), "wb")
+        f.write(result['decoded'])
+        f.close()
+        if result['image'] is not result['decoded']:
+            f = open(os.path.join(tmp, "alice-py.bin"), "wb")
+            f.write(result['image'])
+            f.close()
+        boundaries = array('I', result['boundaries'])
+        if sys.byteorder == 'big':
+            boundaries.byteswap()
+        f = open(os.path.join(tmp, "blocks.bin"), "wb")
+        f.write(boundaries.tobytes())
+        f.close()
+        f = open(os.path.join(tmp, "meta.json"), "w")
+        json.dump({'bl': result['bl'], 'blx': result['blx'], 'fallback': result['fallback']}, f)
+        f.close()
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True) # someone else was faster
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith("."):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
                 continue
+            total += size
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+class AliceDecoder:
+    '''
+    Decoder for the ALICE component described by an AliceHeader.
+
+    decode() returns the whole image, iter_image() yields it a run of blocks
+    at a time. Nothing is kept between calls and nothing is written to disk,
+    so a long running process can decode any number of images, from several
+    threads if need be. With jobs > 1, decode() splits the work across a
+    process pool and falls back to a serial decode if the mapping table does
+    not match the stream. Given a DecodeCache, decode() returns cached
+    results for components decoded before. Given a Stats, the stages of
+    each decode are timed and the symbols and blocks counted.
+    '''
+
+    def __init__(self, header, translate=True, jobs=1, cache=None, stats=None):
+        self.header = header
+        self.translate = translate
+        self.jobs = jobs
+        self.cache = cache
+        self.stats = stats
+
+    def decode(self):
+        # Returns a dict: decoded (the stream as stored, BL/BLX targets
+        # translated), image (BL/BLX untranslated unless translate is off),
+        # bl and blx counts, start of every block (boundaries) and whether
+        # a parallel decode had to fall back to serial (fallback), and
+        # whether it came from the cache (cached)
+        stats = self.stats
+        if self.cache is not None:
+            with stage(stats, 'cache'):
+                key = self.cache.key(self.header, self.translate)
+                result = self.cache.get(key)
+            if result is not None:
+                result['cached'] = True
+                if stats is not None:
+                    stats.count('cached')
+                return result
+
+        alice = self.header.fields
+        symbols = stats.symbols if stats is not None else None
+        result = None
+        fallback = False
+        if self.jobs > 1:
+            source = self.header.source
+            if not isinstance(source, (str, bytes)):
+                source = bytes(source) # mmap and memoryview do not pickle
+            # bitunpack and untranslate are timed in the workers, summed
+            # over all segments. The wall time of the pool is separate.
+            with stage(stats, 'parallel unpack'):
+                result = parallel_unpack(source, alice['offset'], alice, self.jobs, self.translate, stats)
+            fallback = result is None
+            if fallback and stats is not None:
+                stats.symbols[:] = [0]*8
+                stats.count('fallback')
+
+        if result is None:
+            boundaries = array('I')
+            with stage(stats, 'bitunpack'):
+                decoded = bitunpack(alice['buff'], alice['mapaddrs'], alice['maplens'], alice['instrdict'], alice['range_regs'], alice['blocksize'], boundaries=boundaries, symbols=symbols)[0]
+            bl_count = blx_count = 0
+            image = decoded
+            if self.translate:
+                with stage(stats, 'untranslate'):
+                    image = bytearray(decoded)
+                    bl_count, blx_count = untranslate_bl_blx(image)
+        else:
+            decoded, image, bl_count, blx_count, boundaries = result
+        result = {'decoded': decoded, 'image': image, 'bl': bl_count, 'blx': blx_count,
+            'boundaries': boundaries, 'fallback': fallback, 'cached': False}
+        if stats is not None:
+            stats.count('bl', 2*bl_count)
+            stats.count('blx', 2*blx_count)
+            self.count_blocks(boundaries)
+        if self.cache is not None:
+            with stage(stats, 'cache'):
+                self.cache.put(key, result)
+        return result
+
+    def count_blocks(self, boundaries):
+        # Blocks decoded, and how many of them start where the mapping
+        # table says
+        self.stats.count('blocks', len(boundaries))
+        mismatched = [b for b, addr, expected in self.verify(boundaries) if addr is not None]
+        self.stats.count('matched_blocks', len(boundaries) - len(mismatched))
+
+    def iter_image(self, pairs=512, boundaries=None):
+        return iter_image(self.header.fields, self.translate, pairs, boundaries, self.stats)
 
-            if instr & 0x400: # if J2 bit is set
-                # shift imm11 left 11 bits, add lower bits from imm10 + sign
-                # multiply by two, subtract 0x7ffffffe?
-                v10 = int((((instr & 0x7ff) << 0x0c) + ((instr2 & 0x7ff) << 1))/2) - (ptr-1) + 0x7ffffffe
-            else:
-                # shift imm11 left 11 bits, add lower bits from imm10 + sign
-                # multiply by two, add 2
-                v10 = int((((instr & 0x7ff) << 0x0c) + ((instr2 & 0x7ff) << 1))/2) - (ptr-1) - 0x00000002
-
-#            print("-%d translated type 0x%04x from 0x%08x to 0x%08x"%(ptr, upbits, ((instr & 0x7ff) << 0x0c) + ((instr2 & 0x7ff) << 1), v10))
-#            print("%d 0x%08x"%(ptr,v10))
-
-            # reassemble branch target
-            instr = (v10 >> 0x0b) & 0x7ff | 0xf000 # high bits
-            instr2 = v10 & 0x7ff | upbits   # low bits
-
-#            print("-translated 0x%04x to 0x%04x at 0x%x, diff = %d"%(buff[ptr*2] | buff[ptr*2+1] << 8, instr, ptr*2, (buff[ptr*2] | buff[ptr*2+1] << 8) - instr))
-            buff[ptr*2] = instr & 0xff
-            buff[ptr*2+1] = (instr >> 8) & 0xff
-#            print("-translated 0x%04x to 0x%04x at 0x%x, diff = %d"%(buff[ptr*2+2] | buff[ptr*2+3] << 8, instr2, ptr*2+2, (buff[ptr*2+2] | buff[ptr*2+3] << 8) - instr2))
-            buff[ptr*2+2] = instr2 & 0xff
-            buff[ptr*2+3] = (instr2 >> 8) & 0xff
-
-            ptr += 1
-        ptr += 1
-
-    print("translated %d bl and %d blx instructions"%(bl_count*2, blx_count*2))
-
-# ALICE
-# -t ALICE
-
-notranslate = 0
-if len(sys.argv) == 3 and sys.argv[1] == "-t":
-    alicefile = sys.argv[2]
-    notranslate = 1
-elif len(sys.argv) == 2 and sys.argv[1] != "-t":
-    alicefile = sys.argv[1]
-elif len(sys.argv) < 2 or len(sys.argv) > 3:
-    print("usage: unalice.py [-t] <ALICE>")
+    def verify(self, boundaries):
+        return verify_blocks(self.header.blockstarts, boundaries)
+
+def pair_span(alice, k0, k1):
+    # Compressed bytes of block pairs k0 up to k1 (to the end of the data
+    # if k1 is the last pair or past it), from the mapping table
+    mapaddrs = alice['mapaddrs']
+    start = mapaddrs[k0] if k0 > 0 else 0
+    if k1 >= len(mapaddrs) - 1:
+        return alice['buff'][start:]
+    return alice['buff'][start:mapaddrs[k1]]
+
+def decode_pairs(alice, k0, k1, translate=True):
+    # Decode block pairs k0 up to k1 on their own, located through the
+    # mapping table. k0 must be a multiple of the plan_segments() step so
+    # no BL/BLX pair straddles the start. Raises ValueError if the decoded
+    # pairs do not end where the mapping table says.
+    mapaddrs = alice['mapaddrs']
+    blocksize = alice['blocksize']
+    start = mapaddrs[k0] if k0 > 0 else 0
+    stopblock = 2*k1 if k1 < len(mapaddrs) - 1 else None
+    buff, bitptr = bitunpack(pair_span(alice, k0, k1), mapaddrs, alice['maplens'], alice['instrdict'], alice['range_regs'], blocksize, start, 2*k0, stopblock)
+    if stopblock is not None and len(buff) == (k1 - k0)*2*blocksize and start*8 + bitptr != mapaddrs[k1]*8:
+        raise ValueError("block pair %d ends at 0x%08x, mapping table says 0x%08x"%(k1-1, start + (bitptr >> 3), mapaddrs[k1]))
+    if translate:
+        untranslate_bl_blx(buff, k0*blocksize)
+    return buff
+
+class AliceImage:
+    '''
+    Random access to the decompressed contents of an ALICE file.
+
+    read(addr, length) returns the bytes at decompressed offset addr, as they
+    would appear in alice-py.bin. Only the blocks covering the requested range
+    are decoded, located through the mapping table, and kept in a bounded LRU
+    cache.
+    '''
+
+    def __init__(self, alicefile, translate=True, cache_size=256, offset=0):
+        self.alice = read_alice(alicefile, offset)
+        self.translate = translate
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+        blocksize = self.alice['blocksize']
+        self.npairs = len(self.alice['mapaddrs']) - 1
+        # Decode unit, in block pairs. Same alignment as plan_segments() so
+        # BL/BLX pairs never straddle two units.
+        self.step = pair_step(blocksize)
+        self.chunksize = self.step*2*blocksize
+
+    def decode_chunk(self, c):
+        k0 = c*self.step
+        if k0 >= max(self.npairs, 1):
+            return bytearray()
+        return decode_pairs(self.alice, k0, k0 + self.step, self.translate)
+
+    def chunk(self, c):
+        buff = self.cache.get(c)
+        if buff is not None:
+            self.cache.move_to_end(c)
+            return buff
+        buff = self.decode_chunk(c)
+        self.cache[c] = buff
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return buff
+
+    def read(self, addr, length):
+        out = bytearray()
+        while length > 0:
+            c, off = divmod(addr, self.chunksize)
+            buff = self.chunk(c)
+            part = buff[off:off+length]
+            out += part
+            if len(buff) < self.chunksize or len(part) == 0:
+                break # end of image
+            addr += len(part)
+            length -= len(part)
+        return bytes(out)
+
+def print_verify(alice, boundaries):
+    mismatches = verify_blocks(alice['blockstarts'], boundaries)
+    for b, addr, expected in mismatches[0:20]:
+        if addr is None:
+            print("--- block %d not decoded, mapping table says 0x%08x"%(b, expected))
+        elif expected is None:
+            print("--- block %d @ 0x%08x, not in mapping table"%(b, addr))
+        else:
+            print("--- block %d @ 0x%08x, mapping table says 0x%08x"%(b, addr, expected))
+    if len(mismatches) > 20:
+        print("--- ... %d more"%(len(mismatches) - 20))
+    print("verified %d blocks against %d mapping entries, %d mismatches"%(len(boundaries), len(alice['mapaddrs']), len(mismatches)))
+    missing = len([b for b, addr, expected in mismatches if addr is None])
+    if missing:
+        print("%d blocks in the mapping table were not decoded"%(missing))
+
+def write_stats(stats, statsfile, alice, decoded_size):
+    # JSON report of an instrumented run, statsfile is a file name or an
+    # open file
+    report = stats.as_dict()
+    report.update({
+        'compressed_size': len(alice['buff']),
+        'decoded_size': decoded_size,
+        'mapping_entries': len(alice['mapaddrs']),
+        'dictionary_entries': len(alice['instrdict']),
+        'range_regs': alice['range_regs'],
+        'blocksize': alice['blocksize'],
+    })
+    f = statsfile if not isinstance(statsfile, str) else open(statsfile, "w")
+    json.dump(report, f, indent=2)
+    f.write("\n")
+    if isinstance(statsfile, str):
+        f.close()
+
+def usage():
+    print("usage: unalice.py [-a] [-t] [-v] [-j N] [-o offset] [--verify] [--output file] [--stats file] <ALICE>")
+    print("       -a detect header layout and whether to translate bl/blx from sampled blocks")
     print("       -t disable bl/blx addr translation (required for some images)")
-    sys.exit()
-
-f = open(alicefile, "rb")
-magic = f.read(7)
-if magic == b'ALICE_1':
-    alice_version = 1
-elif magic == b'ALICE_2':
-    alice_version = 2
-else:
-    print("found %s, expected ALICE_2, quitting."%(magic))
-    sys.exit(1)
-print("found %s magic"%(magic))
-
-header_size = 40 # ALICE_2 or ALICE_1 with full header
-if alice_version == 1:
-    f.seek(36) # Check ALICE_1
-    endbytes = f.read(4)
-    if endbytes != b'\x00\x00\xff\xff':
-        header_size = 36 # ALICE_1 with short header
-
-f.seek(8)
-base, mapping_offset, dict_offset = struct.unpack("<LLL", f.read(12))
-f.seek(0,2)
-filesize = f.tell()
-mapping_offset -= base - header_size
-dict_offset -= base - header_size
-compressed_offset = header_size
-
-f.seek(20) # Range registers
-reads = 0
-range_regs = []
-while reads < 7:
-    #reg = int(math.pow(2, struct.unpack("<H", f.read(2))[0]))
-    reg = struct.unpack("<H", f.read(2))[0]
-    range_regs.append(reg)
-    reads += 1
-range_regs.append(16) # for infrequent instructions (0x70000 | instr) length 16+3=19
-
-f.read(2)
-blocksize = 0
-if header_size == 40:
-    blocksize = struct.unpack("<H", f.read(2))[0]
-if blocksize == 0:
-    blocksize = 64 # FIXME correct default for ALICE_1?
-
-print("filesize %d bytes"%(filesize))
-print("base 0x%08x"%(base))
-print("header length %d"%(header_size))
-print("blocksize %d bytes (%d instructions)"%(blocksize, blocksize/2))
-print("compressed @ 0x%08x, len 0x%08x"%(compressed_offset, mapping_offset - compressed_offset))
-print("maptable @ 0x%08x, len 0x%08x"%(mapping_offset, dict_offset - mapping_offset))
-print("dictionary @ 0x%08x, len 0x%08x"%(dict_offset, filesize - dict_offset))
-print("range registers (encoded lengths): %s"%(range_regs))
-f.seek(compressed_offset) # size of ALICE header
-
-buff = bytearray(f.read(mapping_offset - compressed_offset))
-
-reads = 0
-mappings = []
-while reads < dict_offset - mapping_offset:
-    mapping = struct.unpack("<L", f.read(4))[0]
-    addr = (mapping - base) & 0x00ffffff
-    length = mapping & 0xff000000
-    if length != 0:
-        length = (((mapping & 0xff000000)>>26) + (3*int(blocksize/2) >> 3)) + 1 # FIXME hardcoded 26
-    print("mapping entry 0x%08x addr 0x%08x len %d"%(mapping, addr, length))
-    mappings.append((addr, length))
-    reads += 4
-
-print("mappings length: %d"%(len(mappings)))
-
-#mappingsbits = [a + (((b>>0x1a) + 3*(blocksize/2) >> 3) + 1) for a,b in mappings]
-#print(mappingsbits)
-
-print("last nonzero mapping: 0x%08x, len = %d"%(mappings[-2][0], mappings[-2][1]))
-
-reads = 0
-instrdict = []
-while reads < filesize - dict_offset:
-    instr = struct.unpack("<H", f.read(2))[0]
-    instrdict.append(instr)
-    reads += 2
-
-print("read %d dictionary entries"%(len(instrdict)))
-print("--- first %s"%(instrdict[0:4]))
-print("--- last %s"%(instrdict[-1]))
-
-f.close()
-
-bitbuff = BitArray(buff)
-
-print("loaded compressed alice %d bytes"%(len(bitbuff)/8))
-
-fout = open("alice-translated-py.bin", "wb")
-alicebin = bytearray()
-
-sys.stdout.flush()
-
-print("unpacking alice...")
-#try:
-bitunpack()
-print("done")
-#except:
-#    pass 
-
-fout.close()
-
-buff = alicebin
-if not notranslate:
-    print("bl/blx address translation...")
-    untranslate_bl_blx()
+    print("       -o offset of the ALICE header in the file, e.g. a full firmware dump")
+    print("       -v print every mapping table entry")
+    print("       -j, --jobs N decode N segments in parallel (default 1)")
+    print("       --verify check every decoded block boundary against the mapping table")
+    print("       --output file stream the decompressed image to file (- for stdout) instead")
+    print("          of writing alice-py.bin and alice-translated-py.bin")
+    print("       --cache dir keep decoded images in dir, repeat decodes are read from there")
+    print("       --cache-size MB evict least recently used images beyond MB (default 1024)")
+    print("       --stats file write the time spent in each stage, symbol and block counts as")
+    print("          JSON to file (- for stdout)")
+
+def main():
+    # ALICE
+    # -t ALICE
+    # -j 4 ALICE
+    # -o 0x17fee0 firmware.bin
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "atvj:o:", ["jobs=", "verify", "output=", "cache=", "cache-size=", "stats="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit()
+    if len(args) != 1:
+        usage()
+        sys.exit()
+    alicefile = args[0]
+
+    notranslate = 0
+    auto = False
+    jobs = 1
+    offset = 0
+    verify = False
+    output = None
+    cachedir = None
+    cachesize = 1024
+    verbose = False
+    statsfile = None
+    for o, a in opts:
+        if o == "-t":
+            notranslate = 1
+        elif o == "-v":
+            verbose = True
+        elif o == "-a":
+            auto = True
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "-o":
+            offset = int(a, 0)
+        elif o == "--verify":
+            verify = True
+        elif o == "--output":
+            output = a
+        elif o == "--cache":
+            cachedir = a
+        elif o == "--cache-size":
+            cachesize = int(a)
+        elif o == "--stats":
+            statsfile = a
+
+    stats = None
+    if statsfile is not None:
+        stats = Stats()
+
+    if output == "-":
+        if statsfile == "-":
+            print("--output - and --stats - cannot both use stdout")
+            sys.exit(1)
+        # The image goes to stdout, everything else to stderr
+        stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    elif output is not None:
+        stream = open(output, "wb")
+    if statsfile == "-":
+        # Same for the stats
+        statsfile = sys.stdout
+        sys.stdout = sys.stderr
+
+    try:
+        header_size = blocksize = None
+        if auto:
+            found = detect(map_file(alicefile), offset)
+            print("detected header length %d, blocksize %d (%d layouts tried, %.0f%% of sampled blocks match)"%(
+                found['header_size'], found['blocksize'], found['layouts'], found['layout_score']*100))
+            print("detected bl/blx %s (%d branches, %.0f%% / %.0f%% of targets inside the image translated / not)"%(
+                "translated" if found['translate'] else "not translated", found['branches'],
+                found['translated_score'][0]*100, found['plain_score'][0]*100))
+            header_size = found['header_size']
+            blocksize = found['blocksize']
+            if not notranslate:
+                notranslate = 0 if found['translate'] else 1
+        header = AliceHeader.from_file(alicefile, offset, header_size, blocksize, stats)
+    except ValueError as e:
+        print("%s, quitting."%(e))
+        sys.exit(1)
+    alice = header.fields
+    cache = None
+    if cachedir is not None:
+        cache = DecodeCache(cachedir, cachesize << 20)
+    decoder = AliceDecoder(header, not notranslate, jobs, cache, stats)
+    print("found %s magic"%(alice['magic']))
+
+    blocksize = alice['blocksize']
+    compressed_offset = alice['compressed_offset']
+    mapping_offset = alice['mapping_offset']
+    dict_offset = alice['dict_offset']
+    filesize = alice['filesize']
+    mapaddrs = alice['mapaddrs']
+    maplens = alice['maplens']
+    instrdict = alice['instrdict']
+
+    if offset:
+        print("ALICE @ 0x%08x in %s"%(offset, alicefile))
+    print("filesize %d bytes"%(filesize))
+    print("base 0x%08x"%(alice['base']))
+    print("header length %d"%(alice['header_size']))
+    print("blocksize %d bytes (%d instructions)"%(blocksize, blocksize/2))
+    print("compressed @ 0x%08x, len 0x%08x"%(compressed_offset, mapping_offset - compressed_offset))
+    print("maptable @ 0x%08x, len 0x%08x"%(mapping_offset, dict_offset - mapping_offset))
+    print("dictionary @ 0x%08x, len 0x%08x"%(dict_offset, filesize - dict_offset))
+    print("range registers (encoded lengths): %s"%(alice['range_regs']))
+
+    if verbose:
+        for mapping, addr, length in zip(alice['rawmappings'], mapaddrs, maplens):
+            print("mapping entry 0x%08x addr 0x%08x len %d"%(mapping, addr, length))
+    print("mappings length: %d"%(len(mapaddrs)))
+    if len(mapaddrs) > 1:
+        print("last nonzero mapping: 0x%08x, len = %d"%(mapaddrs[-2], maplens[-2]))
+
+    print("read %d dictionary entries"%(len(instrdict)))
+    print("--- first %s"%(instrdict[0:4].tolist()))
+    print("--- last %s"%(instrdict[-1]))
+
+    print("loaded compressed alice %d bytes"%(len(alice['buff'])))
+
+    sys.stdout.flush()
+
+    if output is not None:
+        print("streaming alice to %s..."%(output))
+        boundaries = array('I')
+        length = 0
+        for buff in decoder.iter_image(boundaries=boundaries):
+            with stage(stats, 'write'):
+                stream.write(buff)
+            length += len(buff)
+        with stage(stats, 'write'):
+            stream.flush()
+            if output != "-":
+                stream.close()
+        print("wrote %d bytes"%(length))
+        if verify:
+            print_verify(alice, boundaries)
+        if stats is not None:
+            decoder.count_blocks(boundaries)
+            write_stats(stats, statsfile, alice, length)
+        return
+
+    if jobs > 1:
+        print("unpacking alice with %d jobs..."%(jobs))
+    else:
+        print("unpacking alice...")
+    result = decoder.decode()
+    if result['cached']:
+        print("found in cache %s"%(cachedir))
+    elif result['fallback']:
+        print("mapping table does not match decoded blocks, decoded serially")
     print("done")
-else:
-    print("skipping bl/blx address translation")
 
-print("writing alice-py.bin %d bytes"%(len(buff)))
-falicebin = open("alice-py.bin", "wb")
-falicebin.write(buff)
-falicebin.close()
+    if verify:
+        print_verify(alice, result['boundaries'])
+
+    with stage(stats, 'write'):
+        fout = open("alice-translated-py.bin", "wb")
+        fout.write(result['decoded'])
+        fout.close()
+
+    buff = result['image']
+    if not notranslate:
+        print("translated %d bl and %d blx instructions"%(result['bl']*2, result['blx']*2))
+    else:
+        print("skipping bl/blx address translation")
+
+    print("writing alice-py.bin %d bytes"%(len(buff)))
+    with stage(stats, 'write'):
+        falicebin = open("alice-py.bin", "wb")
+        falicebin.write(buff)
+        falicebin.close()
+
+    print("done")
+    if stats is not None:
+        write_stats(stats, statsfile, alice, len(buff))
 
-print("done")
+if __name__ == '__main__':
+    main()
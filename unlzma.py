@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+'''
+LZMA unpack
+
+Unpack the LZMA compressed ZIMAGE (ZIMAGE_ER resources) and DCMCMP
+partitions of Mediatek firmware.
+
+Each partition holds a number of individual LZMA streams (.lzma "alone"
+format: properties byte, 32-bit dictionary size, 64-bit uncompressed size).
+The streams are found by scanning for plausible LZMA headers, then all
+candidates are decompressed concurrently in a thread pool (lzma releases the
+GIL). Candidates that fail to decode, or that lie inside a stream that did,
+are chance matches and are discarded.
+
+Input is memory mapped and fed to the decompressor in chunks, output is
+written to disk as it is produced, so memory use does not depend on the size
+of the resources.
+
+Given a full firmware dump, the ZIMAGE, BOOT_ZIMAGE and DCMCMP partitions
+are located with fwscan.py. Any other file is scanned as a whole.
+
+Requirements:
+    python3
+
+Copyright 2018 Donn Morrison donn.morrison@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import sys
+import lzma
+import mmap
+import struct
+import getopt
+import concurrent.futures
+
+import fwscan
+
+CHUNK = 1 << 20
+
+# lc=3 lp=0 pb=2 properties, dictionary size a multiple of 64K
+LZMA_HEADER_RE = re.compile(rb'\x5d\x00\x00', re.S)
+
+LZMA_PARTS = ('ZIMAGE', 'BOOT_ZIMAGE', 'DCMCMP')
+
+def find_streams(data, start, end):
+    # Offsets of plausible LZMA headers in data[start:end]
+    offsets = []
+    for m in LZMA_HEADER_RE.finditer(data, start, end):
+        offset = m.start()
+        if offset + 13 > end:
+            break
+        dictsize, usize = struct.unpack_from("<LQ", data, offset + 1)
+        if dictsize < 0x10000 or dictsize > 0x10000000:
+            continue
+        if usize != 0xffffffffffffffff and (usize == 0 or usize >= 1 << 32):
+            continue
+        offsets.append(offset)
+    return offsets
+
+def unpack_stream(data, offset, end, filename):
+    # Decompress the stream at offset to filename. Returns the offset where
+    # the stream ends and the number of bytes written, or None if it is not
+    # a valid stream.
+    dec = lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+    pos = offset
+    written = 0
+    f = open(filename, "wb")
+    try:
+        while not dec.eof:
+            chunk = b''
+            if dec.needs_input:
+                if pos >= end:
+                    raise lzma.LZMAError("truncated stream")
+                chunk = data[pos:min(pos + CHUNK, end)]
+                pos += len(chunk)
+            out = dec.decompress(chunk, CHUNK)
+            f.write(out)
+            written += len(out)
+    except lzma.LZMAError:
+        f.close()
+        os.remove(filename)
+        return None
+    f.close()
+    return pos - len(dec.unused_data), written
+
+def unpack_partition(data, name, start, end, outdir, pool):
+    # Returns a list of (offset, end, written, filename) for every stream
+    jobs = []
+    for offset in find_streams(data, start, end):
+        filename = os.path.join(outdir, "%s_%08x.bin"%(name.lower(), offset))
+        jobs.append((offset, filename, pool.submit(unpack_stream, data, offset, end, filename)))
+
+    streams = []
+    for offset, filename, job in jobs:
+        result = job.result()
+        if result is None:
+            continue
+        streams.append((offset, result[0], result[1], filename))
+
+    # Drop candidates that decoded but start inside an earlier stream
+    valid = []
+    for stream in streams:
+        if valid and stream[0] < valid[-1][1]:
+            os.remove(stream[3])
+            continue
+        valid.append(stream)
+    return valid
+
+def usage():
+    print("usage: unlzma.py [-j N] [-x outdir] <firmware|partition>")
+    print("       -j, --jobs N number of decompression threads (default %d)"%(os.cpu_count() or 1))
+    print("       -x output directory (default lzma-py)")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:x:", ["jobs="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+
+    jobs = os.cpu_count() or 1
+    outdir = "lzma-py"
+    for o, a in opts:
+        if o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "-x":
+            outdir = a
+
+    f = open(args[0], "rb")
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+
+    parts = [p for p in fwscan.scan(data) if p['name'] in LZMA_PARTS]
+    if not parts:
+        print("no ZIMAGE/DCMCMP partitions found, scanning whole file")
+        parts = [{'name': 'LZMA', 'offset': 0, 'size': len(data)}]
+
+    os.makedirs(outdir, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for part in parts:
+            start = part['offset']
+            end = start + part['size']
+            print("%s @ 0x%08x, len 0x%08x"%(part['name'], start, part['size']))
+            streams = unpack_partition(data, part['name'], start, end, outdir, pool)
+            for offset, streamend, written, filename in streams:
+                print("--- stream @ 0x%08x, len 0x%08x -> %s %d bytes"%(offset, streamend - offset, filename, written))
+            print("unpacked %d streams"%(len(streams)))
+
+if __name__ == '__main__':
+    main()